@@ -10,6 +10,10 @@ import hashlib
 import logging
 import binascii
 import glob
+import socket
+import threading
+import itertools
+from collections import deque
 from functools import partial
 from py2_3 import *
 from CirrolusPeer import *
@@ -33,15 +37,34 @@ logger = logging.getLogger("CirrolusPeer")
 
 
 USAGE = """Usage: {} USERNAME [port]""".format(sys.argv[0])
+# any THRESHOLD fragments of an uploaded file allow to restore it
+THRESHOLD = 4
+# codec public files are compressed with, if a sample shows it pays off
+COMPRESSION = "zlib"
+# stream the fragments to the peers while they are encoded, instead of
+# writing them to cache/upload first (peers need to support message 11).
+# Off by default: only the upload scheduler limits the uploads at once and
+# retries a failed upload on a spare peer
+PIPELINED = False
+# fragments requested at the same time by a download, seconds after which
+# the next peers are asked as well if fragments are still missing, and
+# seconds after which no new requests are started
+PARALLELDOWNLOADS = 8
+HEDGEAFTER = 2
+DOWNLOADTIMEOUT = 60
+# if the restored file doesn't match its hash, at most that many other
+# combinations of fragments are tried (see restoreVerified)
+MAXRESTORES = 16
 HELPTEXT = {
          "download": "download FILE",
          "getuser":  "getuser",
          "join":     "join IP [PORT]",
          "leave":    "leave",
          "list":     "list",
+         "read":     "read FILE START END",
          "search":   "search [FILENAME]",
          "setuser":  "setuser NAME",
-         "upload":   "upload FILE [p]",
+         "upload":   "upload FILE [p|c]",
 }
 
 
@@ -69,18 +92,23 @@ def parse(peerObject, user, opt):
             print(HELPTEXT[action])
     elif action == 'upload':
         try:
-            private = bool(values[1])
+            # c: public file, equal uploads share the fragments (convergent)
+            convergent = values[1] == 'c'
+            private = not convergent
         except IndexError:
-            private = False
+            private = convergent = False
         try:
             filename = values[0]
+            password = None
             if private and AESSUPPORT:
                 password = input("Password: ")
-                filename = encryptFile(filename, password)
             elif private and not AESSUPPORT:
                 raise RuntimeError("PyCrypto not installed!")
-            s = upload(peerObject, filename, user, private)
-            if s >= 4:
+            # encrypted files don't need the fragments to hide the content
+            s = upload(peerObject, filename, user, private,
+                       systematic=private, convergent=convergent,
+                       password=password)
+            if s >= THRESHOLD:
                 print("Successful: {} fragments uploaded".format(s))
             else:
                 print("Not successful, to few peers")
@@ -96,10 +124,9 @@ def parse(peerObject, user, opt):
         except IndexError:
             filename = None
         result = search(peerObject, filename, user)
-        try:
-            result = result[user]
-            printSearch(result, user)
-        except KeyError:
+        if result.get(user):
+            printSearch(result[user], user)
+        else:
             print("Nothing found")
     elif action == 'list':
         print(peerObject.peers)
@@ -111,6 +138,20 @@ def parse(peerObject, user, opt):
         except IndexError:
             print(HELPTEXT[action])
         download(peerObject, filename, user)
+    elif action == 'read':
+        try:
+            filename = values[0]
+            start, end = int(values[1]), int(values[2])
+        except (IndexError, ValueError):
+            print(HELPTEXT[action])
+            return
+        data = downloadRange(peerObject, filename, user, start, end)
+        if data is not None:
+            dir = "./download"
+            makeDir(dir)
+            with open("{}/{}.{}-{}".format(dir, filename, start, end), 'wb') as f:
+                f.write(data)
+            print("Finished: {} bytes".format(len(data)))
     elif action == 'help':
         printHelpText()
     else:
@@ -127,19 +168,71 @@ def printHelpText():
 def encryptFile(filename, password):
     encryptedFile = "./cache/" + os.path.split(filename)[-1]
     assert encryptedFile != filename
-    data = b''
-    with open(filename, 'rb') as f:
-        for b in iter(partial(f.read, 512), b''):
-            data = b''.join((data, b))
     salt = hashlib.sha256(filename.encode()).digest()
     key = genKey(password, salt)
-    cipher = AESCipher(key)
-    data = cipher.encrypt(data)
-    with open(encryptedFile, 'wb') as f:
-        f.write(data)
+    cipher = StreamEncryptor(key)
+    makeDir("./cache")
+    with open(filename, 'rb') as f, open(encryptedFile, 'wb') as out:
+        for b in iter(partial(f.read, SEGMENTSIZE), b''):
+            out.write(cipher.update(b))
+        out.write(cipher.finalize())
     return encryptedFile
 
 
+class DecryptingWriter(object):
+    """
+    Decrypts the data written (see StreamEncryptor) into the file f, it can
+    be passed to restoreFile. Files uploaded before were encrypted with
+    AESCipher as a whole, they are collected and decrypted by close. If the
+    data can't be decrypted, the rest is dropped, so that restoreFile still
+    checks the hash of the encrypted file; close then raises a ValueError:
+    the data matched its hash, so the password is wrong.
+    """
+    def __init__(self, key, f):
+        self.key = key
+        self.f = f
+        self.head = b''
+        self.decryptor = None
+        self.legacy = None
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        try:
+            self._write(data)
+        except ValueError:
+            self.failed = True
+
+    def _write(self, data):
+        if self.decryptor is None and self.legacy is None:
+            self.head += data
+            if len(self.head) < len(MAGIC):
+                return
+            data, self.head = self.head, b''
+            if data.startswith(MAGIC):
+                self.decryptor = StreamDecryptor(self.key)
+            else:
+                self.legacy = []
+        if self.legacy is not None:
+            self.legacy.append(data)
+        else:
+            self.f.write(self.decryptor.update(data))
+
+    def close(self):
+        if self.failed:
+            raise ValueError("Wrong password")
+        if self.legacy is not None:
+            self.f.write(AESCipher(self.key).decrypt(b''.join(self.legacy)))
+        elif self.decryptor is None:
+            raise ValueError("Truncated stream")
+        else:
+            try:
+                self.f.write(self.decryptor.finalize())
+            except ValueError:
+                raise ValueError("Wrong password")
+
+
 def setUser(newname):
     global user
     user = newname
@@ -160,54 +253,86 @@ def parseJoin(values):
         return None
 
 
-def calculateAmountFragments(peerObject):
+def calculateAmountFragments(peerObject, threshold=THRESHOLD):
     """
     returns how many fragments should be created
     0 if there aren't enough
     """
-    if len(peerObject.peers) >= 20:
+    if len(peerObject.peers) >= max(20, threshold / 0.8):
         return int(len(peerObject.peers)*0.8)
-    elif len(peerObject.peers) < 4:
+    elif len(peerObject.peers) < threshold:
         return 0
     else:
         return len(peerObject.peers)
 
 
-def upload(peerObject, filename, user, private):
+def upload(peerObject, filename, user, private, threshold=THRESHOLD,
+           systematic=False, convergent=False, compression=COMPRESSION,
+           password=None, pipelined=PIPELINED):
     """
-    Uploads file 'filename'
+    Uploads file 'filename', any 'threshold' fragments allow to restore it.
+    If systematic is set, the systematic code is used, if convergent is set,
+    the fragments only depend on the content (see createFragments). Public
+    files are compressed with 'compression' if that shrinks them, private
+    ones are encrypted with password.
+    The fragments are created in cache/upload, uploaded in parallel by
+    peerObject.uploads (see UploadScheduler) and removed afterwards, the
+    peers that aren't needed are spares for any failed upload and the
+    number of uploads at once is limited. If pipelined is set, the file is
+    read, encrypted, encoded and sent to the peers in one pass instead (see
+    FragmentSender), without a limit, spare peers only replace the ones
+    that can't be reached and a failed upload isn't retried.
     returns number of successful uploads
     """
-    n = calculateAmountFragments(peerObject)
+    n = calculateAmountFragments(peerObject, threshold)
     if not n:
         return 0
-    files = createFragments(filename, n, uploader=user, private=private)
-    failed = []
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(filename)
+    # encrypted files don't shrink anyway
+    if private:
+        compression = None
+    options = dict(uploader=user, private=private, threshold=threshold,
+                   systematic=systematic, convergent=convergent,
+                   compression=chooseCompression(filename, compression))
+    if pipelined:
+        cipher = None
+        if private:
+            salt = hashlib.sha256(filename.encode()).digest()
+            cipher = StreamEncryptor(genKey(password, salt))
+        peers = peerObject.getRandomPeers(len(peerObject.peers))
+        chosen, spares = iter(peers[:n]), iter(peers[n:])
+        senders = createFragments(
+            filename, n, cipher=cipher,
+            openWriter=lambda x: FragmentSender(
+                peerObject, next(chosen), spares=lambda: next(spares, None)),
+            **options)
+        return len([i for i in senders if i.join()])
+    if private:
+        filename = encryptFile(filename, password)
+    files = createFragments(filename, n, **options)
     peers = peerObject.getRandomPeers(len(peerObject.peers))
-    for i in range(n):
-        try:
-            data = b''
-            with open(files[i], 'rb') as f:
-                for b in iter(partial(f.read, 512), b''):
-                    data = b''.join((data, b))
-            if not peerObject.uploadFragment0(peers[i], data):
-                failed.append(files[i])
-        except IOError:
-            failed.append(files[i])
-        except IndexError:
-            break
-    return n - len(failed)
+    try:
+        stored = peerObject.uploads.upload(files, peers)
+    finally:
+        for i in files:
+            os.remove(i)
+        if private:
+            os.remove(filename)
+    return len([i for i in stored if i is not None])
 
 
-def search(peerObject, filename, user):
+def search(peerObject, filename, user, callback=None):
+    """
+    Searches the files of user named filename (all if it's None) and
+    returns {username: {hash of the file: hash of the filename}}. callback
+    gets the partial results (see searchRequest0).
+    """
     if filename is not None:
         hash = hashlib.sha256(filename.encode()).digest()
     else:
         hash = 32 * b'\x00'
-    peerObject.searchRequest0(hash, user)
-    result = peerObject.latestSearchResults.copy()
-    peerObject.latestSearchResults = {}
-    return result
+    return peerObject.searchRequest0(hash, user, callback=callback).files
 
 
 def leave(peerObject):
@@ -215,13 +340,12 @@ def leave(peerObject):
     p.running = False
 
 
-def download(peerObject, filename, user):
-    result = search(peerObject, filename, user)
-    try:
-        result = result[user]
-    except IndexError:
-        print("No such file found")
-        return -1
+def chooseFile(peerObject, filename, user):
+    """
+    Searches the file 'filename' of user and lets the user choose if there
+    are several. returns the hex SHA256 of the file (bytes) or None
+    """
+    result = search(peerObject, filename, user).get(user, {})
     if len(result) > 1:
         printSearch(result, user)
         while True:
@@ -236,30 +360,169 @@ same name, choose one:")) - 1
                 continue
     elif len(result) < 1:
         print("No such file found")
-        return -1
+        return None
     else:
         toDownload = list(result.keys())[0].encode()
+    return toDownload
+
+
+def downloadRange(peerObject, filename, user, start, end):
+    """
+    Downloads the bytes [start, end) of the file 'filename'. Only the
+    stripes of the fragments that hold the range are transferred.
+    returns the data or None
+    """
+    toDownload = chooseFile(peerObject, filename, user)
+    if toDownload is None:
+        return None
     hash = binascii.unhexlify(toDownload)
-    toDownload = "./cache/save/{}/*".format(toDownload.decode())
+    meta = None
+    parts = []
+    # the chunks of the range depend on k, it's assumed to be THRESHOLD
+    # until the first reply tells
+    chunksize = 32 * THRESHOLD
+    first, last = start // chunksize, -(-end // chunksize)
     for i in peerObject.peers:
-        peerObject.requestFragment0(i, hash, user.encode())
-        if len(glob.glob(toDownload)) >= 4:
-            break
-    fragments = glob.glob(toDownload)
-    if len(fragments) >= 4:
+        part = peerObject.requestPieces0(i, hash, user.encode(), first, last)
+        if part is None:
+            continue
+        if meta is None:
+            meta = part[0]
+            if meta["private"] or meta["compression"]:
+                print("Ranges of private or compressed files can't be read")
+                return None
+            first, last = chunkRange(meta, start, end)
+            firstPiece, pieces = part[1], part[2]
+            if (firstPiece > first or firstPiece + len(pieces) //
+                    meta["piecesize"] < last):
+                part = peerObject.requestPieces0(i, hash, user.encode(),
+                                                 first, last)
+                if part is None:
+                    continue
+        parts.append(part)
+        if len(parts) >= meta["k"]:
+            return restoreRange(parts, start, end)
+    print("Not enough fragments!")
+    return None
+
+
+def fetchFragments(peerObject, hash, user, parallel=PARALLELDOWNLOADS,
+                   hedgeAfter=HEDGEAFTER, timeout=DOWNLOADTIMEOUT, extra=0):
+    """
+    Requests the fragments of the file with the SHA256 'hash' (bytes) of
+    user from the peers concurrently. As many requests as fragments are
+    missing run at a time, failed ones are replaced by requests to the next
+    peers. For every 'hedgeAfter' seconds that fragments are still missing,
+    that many more peers are asked as well (hedged requests), at most
+    'parallel' at a time. As soon as k (plus 'extra', if the peers have
+    them) valid fragments are saved, the outstanding requests are
+    cancelled.
+    returns the filenames of the fragments, [] if there aren't enough
+    """
+    toDownload = "./cache/save/{}/*".format(binascii.hexlify(hash).decode())
+    peers = deque(peerObject.getRandomPeers(len(peerObject.peers)))
+    active = set()
+    condition = threading.Condition()
+    running = [0]
+
+    def fetch(peer):
+        try:
+            peerObject.requestFragment0(peer, hash, user.encode(), active)
+        finally:
+            with condition:
+                running[0] -= 1
+                condition.notify_all()
+
+    start = time.time()
+    k = None
+    with condition:
+        while True:
+            fragments = glob.glob(toDownload)
+            if fragments and k is None:
+                k = readMeta(fragments[0]).get("k", 4)
+            missing = (k or THRESHOLD) + extra - len(fragments)
+            elapsed = time.time() - start
+            if (missing <= 0 or elapsed > timeout or
+                    not (peers or running[0])):
+                break
+            wanted = min(parallel, missing * (1 + int(elapsed // hedgeAfter)))
+            while peers and running[0] < wanted:
+                running[0] += 1
+                thread = threading.Thread(target=fetch,
+                                          args=(peers.popleft(),))
+                thread.daemon = True
+                thread.start()
+            condition.wait(hedgeAfter - elapsed % hedgeAfter)
+    for connection in list(active):
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    return fragments if k is not None and len(fragments) >= k else []
+
+
+def restoreVerified(peerObject, hash, user, fragments, restore):
+    """
+    Calls restore(fragments) with the fragments of fetchFragments. The
+    Merkle trees only show that a fragment is consistent in itself, a peer
+    may forge one with a matching tree, which is only noticed by the hash of
+    the restored file. If it doesn't match or the fragments can't be
+    decoded (a RuntimeError of restoreFile), the fragments of all peers are
+    fetched and restore is called with other combinations of k of them, at
+    most MAXRESTORES times, until one succeeds. Raises the last error, other
+    errors (e.g. a wrong password) at once.
+    """
+    try:
+        return restore(fragments)
+    except RuntimeError as e:
+        error = e
+    k = readMeta(fragments[0])["k"]
+    tried = set(fragments)
+    fragments = fetchFragments(peerObject, hash, user,
+                               extra=len(peerObject.peers))
+    combinations = (i for i in itertools.combinations(sorted(fragments), k)
+                    if set(i) != tried)
+    for i in itertools.islice(combinations, MAXRESTORES):
+        try:
+            return restore(list(i))
+        except RuntimeError as e:
+            error = e
+    raise error
+
+
+def download(peerObject, filename, user):
+    toDownload = chooseFile(peerObject, filename, user)
+    if toDownload is None:
+        return -1
+    hash = binascii.unhexlify(toDownload)
+    fragments = fetchFragments(peerObject, hash, user)
+    if fragments:
         print("Fragments downloaded")
         print("Starts combining")
-        data, private = combineFragments(fragments)
-        if private:
+        dir = "./download"
+        makeDir(dir)
+        output = "{}/{}".format(dir, filename)
+        key = None
+        if readMeta(fragments[0]).get("private", False):
             password = input("Password: ")
             salt = hashlib.sha256(filename.encode()).digest()
             key = genKey(password, salt)
-            cipher = AESCipher(key)
-            data = cipher.decrypt(data)
-        dir = "./download"
-        makeDir(dir)
-        with open("{}/{}".format(dir, filename), 'wb') as f:
-            f.write(data)
+
+        def restore(fragments):
+            if key is None:
+                return restoreFile(fragments, output)
+            with open(output, 'wb') as f:
+                sink = DecryptingWriter(key, f)
+                restoreFile(fragments, sink)
+                sink.close()
+
+        try:
+            restoreVerified(peerObject, hash, user, fragments, restore)
+        except (RuntimeError, ValueError) as e:
+            print(str(e))
+            if os.path.exists(output):
+                os.remove(output)
+            return -1
         print("Finished")
     else:
         print("Not enough fragments!")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# Author: Loris Reiff
+# Maturaarbeit
+#
+"""
+Benchmarks of the fragment codec. Every case runs in its own process, so
+that the peak RSS can be measured per case. The results can be written to a
+json baseline and later runs compared against it.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+import CirrolusFiles as cf
+from SimplePolynomial import SimplePolynomial
+
+PRIME = 2 ** 261 - 261
+UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30}
+# lagrange and SimplePolynomial are far too slow for whole files
+MAXCHUNKS = 2000
+# every case runs once to warm up and then at least REPEATS times and for at
+# least MINTIME seconds, the best run counts
+REPEATS = 5
+MINTIME = 1.0
+# seconds a case may take before it's given up
+TIMEOUT = 3600
+
+
+def parseSize(size):
+    """'4K' -> 4096"""
+    size = size.strip().upper()
+    if size[-1:] in UNITS:
+        return int(size[:-1]) * UNITS[size[-1]]
+    return int(size)
+
+
+def createInput(filename, size, blocksize=2 ** 20):
+    with open(filename, 'wb') as f:
+        while size > 0:
+            f.write(os.urandom(min(blocksize, size)))
+            size -= blocksize
+
+
+def peakRss():
+    """returns the peak RSS of this process in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def chunkCoordinates(fragments, amount, piecesize=33):
+    """returns the coordinates of the first 'amount' chunks"""
+    coordinates = []
+    for i in fragments:
+        with cf.MappedFragment(i) as f:
+            pieces = f.pieces[:amount*piecesize]
+            x = f.meta["x"]
+            coordinates.append([(x, cf.bs.bytes2int(pieces[j:j+piecesize]))
+                                for j in range(0, len(pieces), piecesize)])
+            pieces.release()
+    return list(zip(*coordinates))
+
+
+def benchCreateFragments(case):
+    start = time.time()
+    cf.createFragments(case["input"], case["fragments"], case["directory"],
+                       threshold=case["threshold"], uploader="benchmark")
+    return time.time() - start, case["size"]
+
+
+def benchCombineFragments(case):
+    start = time.time()
+    cf.combineFragments(case["files"])
+    return time.time() - start, case["size"]
+
+
+def benchRestoreFile(case):
+    start = time.time()
+    cf.restoreFile(case["files"], os.devnull)
+    return time.time() - start, case["size"]
+
+
+def benchReadFragment(case):
+    start = time.time()
+    cf.readFragment(case["files"][0])
+    return time.time() - start, os.path.getsize(case["files"][0])
+
+
+def benchLagrange(case):
+    coordinates = chunkCoordinates(case["files"], MAXCHUNKS)
+    start = time.time()
+    for i in coordinates:
+        cf.lagrange(i, PRIME)
+    return time.time() - start, len(coordinates) * 32 * case["threshold"]
+
+
+def benchPolynomial(case):
+    xValues = random.sample(range(1, 10 ** 18), case["fragments"])
+    k = case["threshold"]
+    polynomes = [SimplePolynomial([random.getrandbits(256) for i in range(k)])
+                 for j in range(min(MAXCHUNKS, case["size"] // (32 * k) + 1))]
+    start = time.time()
+    for polynom in polynomes:
+        for x in xValues:
+            polynom(x, PRIME)
+    return time.time() - start, len(polynomes) * 32 * k
+
+
+BENCHMARKS = {
+    "createFragments": benchCreateFragments,
+    "combineFragments": benchCombineFragments,
+    "restoreFile": benchRestoreFile,
+    "readFragment": benchReadFragment,
+    "lagrange": benchLagrange,
+    "SimplePolynomial": benchPolynomial,
+}
+
+
+def runCase(name, case, queue, repeats=REPEATS, mintime=MINTIME):
+    """
+    Runs the benchmark 'name' once to warm up, then at least 'repeats' times
+    and until the runs took 'mintime' seconds. Puts the times of the runs,
+    the bytes processed and the peak RSS in queue.
+    """
+    BENCHMARKS[name](case)
+    times = []
+    while len(times) < repeats or sum(times) < mintime:
+        seconds, processed = BENCHMARKS[name](case)
+        times.append(seconds)
+    queue.put((times, processed, peakRss()))
+
+
+def measure(name, case, repeats=REPEATS, mintime=MINTIME, timeout=TIMEOUT):
+    """
+    Runs the benchmark 'name' in a new process and returns the result, the
+    best of the runs (see runCase). Raises RuntimeError if the process dies
+    or takes longer than timeout seconds.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=runCase,
+                                      args=(name, case, queue, repeats,
+                                            mintime))
+    process.start()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            try:
+                times, processed, rss = queue.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    raise RuntimeError("{} exited with {}".format(
+                        name, process.exitcode))
+                if time.time() > deadline:
+                    raise RuntimeError("{} timed out".format(name))
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    times.sort()
+    seconds = times[0]
+    chunks = -(-processed // (32 * case["threshold"]))
+    return {
+        "benchmark": name,
+        "size": case["size"],
+        "fragments": case["fragments"],
+        "threshold": case["threshold"],
+        "runs": len(times),
+        "seconds": seconds,
+        "median_seconds": times[len(times) // 2],
+        "mb_per_s": processed / 2 ** 20 / seconds if seconds else None,
+        "peak_rss": rss,
+        "chunk_latency_us": seconds / chunks * 1e6 if chunks else None,
+    }
+
+
+def runGrid(sizes, fragmentCounts, thresholds, benchmarks,
+            repeats=REPEATS, mintime=MINTIME, timeout=TIMEOUT):
+    results = []
+    tmp = tempfile.mkdtemp(prefix="cirrolus-benchmark-")
+    try:
+        for size in sizes:
+            case = {"input": os.path.join(tmp, "input"), "size": size}
+            createInput(case["input"], size)
+            for n in fragmentCounts:
+                for k in [i for i in thresholds if i <= n]:
+                    case.update(fragments=n, threshold=k,
+                                directory=os.path.join(tmp, "{}-{}".format(n, k)))
+                    case["files"] = cf.createFragments(
+                        case["input"], n, case["directory"], threshold=k,
+                        uploader="benchmark")[:k]
+                    for name in benchmarks:
+                        try:
+                            result = measure(name, case, repeats, mintime,
+                                             timeout)
+                        except RuntimeError as e:
+                            print("{} size={} n={} k={} failed: {}".format(
+                                name, size, n, k, e), file=sys.stderr)
+                            continue
+                        printResult(result)
+                        results.append(result)
+                    shutil.rmtree(case["directory"])
+    finally:
+        shutil.rmtree(tmp)
+    return results
+
+
+def resultKey(result):
+    return "{benchmark} size={size} n={fragments} k={threshold}".format(**result)
+
+
+def printResult(result):
+    print("{:60} {:10.2f} MB/s {:10.1f} us/chunk {:8.1f} MB RSS".format(
+        resultKey(result), result["mb_per_s"] or 0,
+        result["chunk_latency_us"] or 0, result["peak_rss"] / 2 ** 20))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the changes against the baseline and returns the list of keys
+    whose throughput dropped by more than 'tolerance'.
+    """
+    old = dict((resultKey(i), i) for i in baseline)
+    regressions = []
+    for result in results:
+        key = resultKey(result)
+        if key not in old or not old[key]["mb_per_s"] or not result["mb_per_s"]:
+            continue
+        ratio = result["mb_per_s"] / old[key]["mb_per_s"]
+        print("{:60} {:+7.1%}".format(key, ratio - 1))
+        if ratio < 1 - tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1K,1M,16M",
+                        help="file sizes, e.g. 1K,1M,1G")
+    parser.add_argument("--fragments", default="4,16,40",
+                        help="amounts of fragments")
+    parser.add_argument("--thresholds", default="4",
+                        help="thresholds k")
+    parser.add_argument("--benchmarks", default=",".join(sorted(BENCHMARKS)))
+    parser.add_argument("--output", help="write the results as json baseline")
+    parser.add_argument("--baseline", help="compare against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed throughput drop against the baseline")
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help="least amount of measured runs per case")
+    parser.add_argument("--min-time", type=float, default=MINTIME,
+                        help="least seconds measured per case")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="seconds after which a case is given up")
+    args = parser.parse_args()
+
+    results = runGrid([parseSize(i) for i in args.sizes.split(",")],
+                      [int(i) for i in args.fragments.split(",")],
+                      [int(i) for i in args.thresholds.split(",")],
+                      args.benchmarks.split(","), args.repeats,
+                      args.min_time, args.timeout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:\n\t" + "\n\t".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,75 @@
 #
 
 from functools import partial
+from collections import deque
+import binascii
 import hashlib
+import sys
+import io
+import mmap
 import os
 import json
 import random
-import glob
+import shutil
+import struct
+import threading
+import zlib
 from SimplePolynomial import SimplePolynomial
 from py2_3 import *
 import bytesSupport as bs
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# version 0: json meta, version 1: json meta, systematic code,
+# version 2: binary header (see packHeader)
+PREFIXES = (b"#CL\x00", b"#CL\x01", b"#CL\x02")
+# the payload of version 2 fragments starts at HEADERSIZE
+HEADERSIZE = 4096
+# prefix, k, piece width, flags, x, amount of pieces, added bytes, SHA256 of
+# the file, SHA256 of the filename, Merkle root of the pieces, pieces per
+# stripe, length of the uploader
+BINARYHEADER = struct.Struct("!4sBBHQQH32s32s32sHB")
+FLAGPRIVATE = 1
+FLAGSYSTEMATIC = 2
+FLAGCONVERGENT = 4
+# the codec the file was compressed with is stored in the flags as index of
+# COMPRESSIONS, shifted by COMPRESSIONSHIFT
+COMPRESSIONS = (None, "zlib", "bz2", "lzma")
+COMPRESSIONSHIFT = 3
+# content addressed store of the payloads of convergent fragments
+STOREDIR = "./store/"
+# folders next to the ones of the uploaders, they aren't indexed and no
+# fragments are saved in them (neither in hidden ones, see isUploader)
+NOTUPLOADERS = ("cache", "store", "download", "__pycache__")
+# pieces per Merkle leaf, the leaves follow the pieces of version 2 fragments
+STRIPE = 1024
 
 
 class FragmentManager(object):
     def __init__(self):
-        self.prefixes = (b"#CL\x00", )
+        self.prefixes = PREFIXES
+        # index of the saved fragments, uploader: {hash of the file:
+        # {hashfilename}} and uploader: {hashfilename: {hash of the file}},
+        # built from the folders by loadIndex at the start of the server
+        # (or at the first lookup)
+        self.index = None
+        self.names = None
+        self.indexLock = threading.Lock()
 
     def isFragment(self, data):
         """returns True if it's a Cirrolus fragment"""
@@ -26,96 +82,754 @@ class FragmentManager(object):
         """
         returns the meta dictionary
         """
-        metaSize = bs.bytes2int(data[4:8])
-        meta = json.loads(data[8:(8+metaSize)].decode())
-        return meta
+        return readHeader(io.BytesIO(data[:HEADERSIZE]))
 
     def saveFile(self, name, data):
-        with open(name, 'wb') as f:
+        """
+        Writes data to a hidden temporary file in the folder of name and
+        renames it, so that name is never seen incomplete (e.g. by
+        fetchFragments while fragments are being received).
+        """
+        dir, base = os.path.split(name)
+        temp = os.path.join(dir, ".{}.{}".format(
+            base, binascii.hexlify(os.urandom(8)).decode()))
+        with open(temp, 'wb') as f:
             f.write(data)
+        os.rename(temp, name)
+
+    def _destination(self, meta, cached=False):
+        """
+        returns the folder and the name the fragment of meta is saved as,
+        None if the uploader can't have a folder (see isUploader)
+        """
+        if cached:
+            return "./cache/save/{}/".format(meta["hash"]), str(meta["x"])
+        if not isUploader(meta["uploader"]):
+            return None
+        return ("./{}/".format(meta["uploader"]),
+                "".join((meta["hash"], meta["filename"])))
 
     def saveFragment(self, data, cached=False):
         """
         If data is a Cirrolus fragment, it will be saved in a folder
         named after the uploader and true will be returned. If cached is set,
         the fragment will be stored in the cache folder. If it isn't a fragment
-        false will be returned.
+        or it is corrupted (see verifyFragmentData) false will be returned.
         """
         if self.isFragment(data):
             meta = self.getMeta(data)
-            if cached:
-                dir = "./cache/save/{}/".format(meta["hash"])
-                filename = str(meta["x"])
-            else:
-                dir = "./{}/".format(meta["uploader"])
-                filename = "".join((meta["hash"], meta["filename"]))
+            destination = self._destination(meta, cached)
+            if destination is None or not verifyFragmentData(data, meta):
+                return False
+            dir, filename = destination
+            if not cached:
+                if meta.get("convergent") and meta.get("pieces"):
+                    # equal for every uploader, only the header is kept as
+                    # reference entry of the uploader (version 2 headers)
+                    self.saveStored(storePath(meta), data[HEADERSIZE:])
+                    data = data[:HEADERSIZE]
             makeDir(dir)
             self.saveFile(dir + filename, data)
+            if not cached:
+                self._addToIndex(meta["uploader"], filename)
             return True
         else:
             return False
 
+    def saveFragmentFile(self, path, cached=False):
+        """
+        Like saveFragment, but the fragment is the file 'path' (e.g. a
+        received one), which is moved to its place. A corrupted fragment is
+        removed.
+        """
+        try:
+            with MappedFragment(path) as f:
+                meta = f.meta
+                valid = f.verify()
+        except (RuntimeError, ValueError, struct.error, IOError, OSError):
+            valid = False
+        destination = self._destination(meta, cached) if valid else None
+        if destination is None:
+            os.remove(path)
+            return False
+        dir, filename = destination
+        if (not cached and meta.get("convergent") and meta.get("pieces") and
+                os.path.getsize(path) > HEADERSIZE):
+            with open(path, 'r+b') as f:
+                f.seek(HEADERSIZE)
+                self.saveStored(storePath(meta), f)
+                f.truncate(HEADERSIZE)
+        makeDir(dir)
+        os.rename(path, dir + filename)
+        if not cached:
+            self._addToIndex(meta["uploader"], filename)
+        return True
+
+    def saveFragmentStream(self, read, size, cached=False, blocksize=2 ** 16):
+        """
+        Like saveFragmentFile, but the fragment of size bytes is read with
+        read(n), e.g. from a connection. The header is read first to find
+        the destination folder, then the fragment is copied block by block
+        into a temporary file there, which is renamed when it's complete.
+        All size bytes are read, also if the fragment is rejected.
+        """
+        head = read(min(size, HEADERSIZE))
+        size -= len(head)
+        try:
+            destination = self._destination(self.getMeta(head), cached)
+        except (RuntimeError, ValueError, struct.error):
+            destination = None
+        if destination is None:
+            while size > 0:
+                size -= len(read(min(size, blocksize)))
+            return False
+        dir, filename = destination
+        makeDir(dir)
+        # not listed by getFragmentPath and getFragmentDict meanwhile
+        temp = "{}.{}.{}".format(dir, filename,
+                                 binascii.hexlify(os.urandom(8)).decode())
+        try:
+            with open(temp, 'wb') as f:
+                f.write(head)
+                while size > 0:
+                    data = read(min(size, blocksize))
+                    f.write(data)
+                    size -= len(data)
+        except BaseException:
+            os.remove(temp)
+            raise
+        return self.saveFragmentFile(temp, cached)
+
+    def saveStored(self, path, data):
+        """
+        Saves the payload of a convergent fragment, bytes or a file object,
+        in the content addressed store, if it isn't stored yet. Several
+        threads may store the same payload at once, each writes its own
+        temporary file and the first one renamed is kept.
+        """
+        if os.path.exists(path):
+            return
+        makeDir(STOREDIR)
+        temp = "{}.{}".format(path, binascii.hexlify(os.urandom(8)).decode())
+        try:
+            with open(temp, 'wb') as f:
+                if hasattr(data, "read"):
+                    shutil.copyfileobj(data, f, 2 ** 16)
+                else:
+                    f.write(data)
+            os.rename(temp, path)
+        except OSError:
+            # stored by another thread meanwhile (rename can't replace it
+            # on Windows)
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def loadIndex(self):
+        """
+        Builds the index of the fragments in the folders of the uploaders,
+        their names are the hash of the file followed by the hashfilename.
+        """
+        with self.indexLock:
+            self._loadIndex()
+
+    def _loadIndex(self):
+        """like loadIndex, has to be called with indexLock"""
+        if self.index is not None:
+            return
+        self.index, self.names = {}, {}
+        for username in os.listdir("."):
+            if not isUploader(username) or not os.path.isdir(username):
+                continue
+            for i in os.listdir(username):
+                if len(i) == 128:
+                    self._indexFragment(username, i)
+
+    def _indexFragment(self, username, filename):
+        hashOfFile, hashfilename = filename[:64], filename[64:]
+        self.index.setdefault(username, {}).setdefault(
+            hashOfFile, set()).add(hashfilename)
+        self.names.setdefault(username, {}).setdefault(
+            hashfilename, set()).add(hashOfFile)
+
+    def _addToIndex(self, username, filename):
+        with self.indexLock:
+            if self.index is not None:
+                self._indexFragment(username, filename)
+
+    def getFragmentPath(self, username, hashOfFile):
+        """
+        Returns the path of the fragment in the folder username that begins
+        with 'hashOfFile'.
+        """
+        with self.indexLock:
+            self._loadIndex()
+            names = list(self.index.get(username, {}).get(hashOfFile, ()))
+        if len(names) != 1:
+            raise FileNotFoundError
+        return os.path.join(".", username, hashOfFile + names[0])
+
+    def getFragmentParts(self, username, hashOfFile):
+        """
+        Returns the parts (filename, offset, size) the fragment in the folder
+        username that begins with 'hashOfFile' consists of. That's the file
+        itself, for references of convergent fragments also the payload in
+        the store.
+        """
+        path = self.getFragmentPath(username, hashOfFile)
+        size = os.path.getsize(path)
+        meta = readMeta(path)
+        parts = [(path, 0, size)]
+        if isReference(meta, size):
+            payload = storePath(meta)
+            parts.append((payload, 0, os.path.getsize(payload)))
+        return parts
+
     def getFragment(self, username, hashOfFile):
         """
         Returns the data of the fragment in the folder username that begins
         with 'hashOfFile'.
         """
-        data = b''
-        files = glob.glob("{}/{}?*".format(username, hashOfFile))
-        if len(files) != 1:
-            raise FileNotFoundError
-        with open(files[0], 'rb') as f:
-            for b in iter(partial(f.read, 1024), b''):
-                data += b
-        return data
+        return readParts(self.getFragmentParts(username, hashOfFile))
+
+    def getPieces(self, username, hashOfFile, first, last):
+        """
+        Returns the header, the index of the first piece, the pieces and the
+        Merkle proofs of the stripes that hold the pieces [first, last) of a
+        version 2 fragment (see getFragment). The range is extended to whole
+        stripes, so that it can be verified with verifyStripes.
+        """
+        with MappedFragment(self.getFragmentPath(username, hashOfFile)) as f:
+            if "root" not in f.meta:
+                raise FileNotFoundError
+            stripe = f.meta["stripe"]
+            stripeBytes = stripe * f.meta["piecesize"]
+            leaves = f.leaves.tobytes()
+            leaves = [leaves[i:i+32] for i in range(0, len(leaves), 32)]
+            start = min(first, last, len(f)) // stripe
+            end = min(-(-last // stripe), len(leaves))
+            levels = merkleLevels(leaves)
+            proofs = [merkleProof(leaves, i, levels) for i in range(start, end)]
+            pieces = f.pieces[start*stripeBytes:end*stripeBytes].tobytes()
+            header = f.header
+        return header, start * stripe, pieces, proofs
 
     def getFragmentDict(self, username, hashfilename=None):
         """
         returns a dictionary of the fragments from 'username'. The key is
         the hash of the file, the value the hashfilename
         """
-        files = [i for i in os.listdir(username) if len(i) == 128]
-        if hashfilename:
-            files = [i for i in files if i[64:] == hashfilename]
-        out = {}
-        for i in files:
-            out[i[:64]] = i[64:]
-        return out
+        with self.indexLock:
+            self._loadIndex()
+            if hashfilename:
+                hashes = self.names.get(username, {}).get(hashfilename, ())
+                return dict((i, hashfilename) for i in hashes)
+            out = {}
+            for hashOfFile, names in self.index.get(username, {}).items():
+                for i in names:
+                    out[hashOfFile] = i
+            return out
+
+
+def readParts(parts):
+    """returns the data of the parts (filename, offset, size) of files"""
+    data = []
+    for filename, offset, size in parts:
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data.append(f.read(size))
+    return b''.join(data)
 
 
 def makeDir(dir):
     """
     Make dir if it doesn't exist.
     """
-    if not os.path.exists(dir):
+    try:
         os.makedirs(dir)
+    except OSError:
+        # it exists already, maybe created by another thread meanwhile
+        if not os.path.isdir(dir):
+            raise
 
 
 def lagrange(coordinates, moduloPrime):
     """
     Lagrange Interpolation modulo 'moduloPrime'
     """
-    sum_ = 0
+    sum_ = SimplePolynomial([], moduloPrime)
     for i in coordinates:
-        temp = i[1]
+        basis = SimplePolynomial([1], moduloPrime)
+        denominator = 1
         for j in coordinates:
             if i != j:
-                # inverse according to fermats little theorem
-                temp *= SimplePolynomial([-j[0], 1]) * \
-                     pow(i[0] - j[0], moduloPrime - 2, moduloPrime)
-        sum_ += temp
-        sum_ %= moduloPrime
+                basis.mulLinear(j[0])
+                denominator = denominator * (i[0] - j[0]) % moduloPrime
+        # inverse according to fermats little theorem
+        inverse = pow(denominator, moduloPrime - 2, moduloPrime)
+        sum_.addScaled(basis, i[1] * inverse)
     return sum_
 
 
-def calcBytesToAdd(filename, chunksize=128):
+def interpolationWeights(xValues, moduloPrime):
+    """
+    Returns the inverse of the Vandermonde matrix of 'xValues' modulo
+    'moduloPrime' as a list of rows. Row i holds the weights of the y values
+    for the coefficient of x^i, therefore the interpolation of a chunk is
+    reduced to a dot product (see interpolateChunk). The weights only depend
+    on the x values and can be reused for every chunk of a file.
+    """
+    k = len(xValues)
+    weights = [[0] * k for i in range(k)]
+    for j in range(k):
+        # the basis polynomial prod(x - x_m), m != j
+        basis = SimplePolynomial([1], moduloPrime)
+        denominator = 1
+        for m in range(k):
+            if m != j:
+                basis.mulLinear(xValues[m])
+                denominator = denominator * (xValues[j] - xValues[m]) % moduloPrime
+        # inverse according to fermats little theorem
+        inverse = pow(denominator, moduloPrime - 2, moduloPrime)
+        for i in range(k):
+            weights[i][j] = basis[i] * inverse % moduloPrime
+    return weights
+
+
+def interpolateChunk(weights, yValues, moduloPrime):
+    """
+    Returns the coefficients of the polynomial through the y values, weights
+    has to be created with interpolationWeights or systematicWeights. A row
+    that is an integer is the index of the y value to take as it is.
     """
-    returns how many bytes have to be added, that the file 'filename' is
-    a multiple of 'chunksize'
+    return [yValues[row] if isinstance(row, integer_types) else
+            sum(w * y for w, y in zip(row, yValues)) % moduloPrime
+            for row in weights]
+
+
+def basisValues(points, x, moduloPrime):
+    """
+    Returns the values of the Lagrange basis polynomials of 'points' at x
+    modulo 'moduloPrime'.
+    """
+    values = []
+    for j in points:
+        numerator = 1
+        denominator = 1
+        for m in points:
+            if m != j:
+                numerator = numerator * (x - m) % moduloPrime
+                denominator = denominator * (j - m) % moduloPrime
+        values.append(numerator * pow(denominator, moduloPrime - 2,
+                                      moduloPrime) % moduloPrime)
+    return values
+
+
+def systematicTable(xValues, moduloPrime, k=4):
+    """
+    Returns the encoding rows of the systematic code for every x in
+    'xValues'. The polynomial of a chunk goes through its k blocks at
+    x = 1, ..., k, hence the fragments with these x values carry the blocks
+    of the file as they are.
+    """
+    points = list(range(1, k + 1))
+    return [basisValues(points, x, moduloPrime) for x in xValues]
+
+
+def systematicWeights(xValues, moduloPrime):
+    """
+    Returns the decoding rows of the systematic code for fragments with the
+    x values 'xValues' (see interpolateChunk). A block whose data fragment
+    is available is taken as it is, only the others are interpolated.
+    """
+    xValues = list(xValues)
+    return [xValues.index(m) if m in xValues else
+            basisValues(xValues, m, moduloPrime)
+            for m in range(1, len(xValues) + 1)]
+
+
+def powerTable(xValues, moduloPrime, k=4):
+    """
+    Returns for every x in 'xValues' the list [1, x, x^2, ..., x^(k-1)]
+    modulo 'moduloPrime'.
+    """
+    table = []
+    for x in xValues:
+        powers = [1]
+        for i in range(k - 1):
+            powers.append(powers[-1] * x % moduloPrime)
+        table.append(powers)
+    return table
+
+
+def evaluateChunk(table, coefficients, moduloPrime):
+    """
+    Evaluates the chunk with the given coefficients at every x of 'table'
+    (see powerTable and systematicTable) and returns the list of y values.
+    """
+    return [sum(c * w for c, w in zip(coefficients, row)) % moduloPrime
+            for row in table]
+
+
+def encodeBlock(table, data, moduloPrime, chunksize=128, piecesize=33):
+    """
+    Encodes data (a multiple of chunksize) and returns the pieces of every x
+    of 'table' as one bytes object per x.
+    """
+    pieceLists = [[] for row in table]
+    for offset in range(0, len(data), chunksize):
+        coefficients = [bs.bytes2int(data[i:i+32])
+                        for i in range(offset, offset + chunksize, 32)]
+        yValues = evaluateChunk(table, coefficients, moduloPrime)
+        for pieceList, y in zip(pieceLists, yValues):
+            pieceList.append(bs.int2bytes(y, piecesize))
+    return [b''.join(i) for i in pieceLists]
+
+
+def interleaveBlock(blocks, piecesize=33):
+    """
+    Restores the data of the blocks of the k data fragments of the
+    systematic code (ordered by x) without any arithmetic.
+    """
+    k = len(blocks)
+    out = bytearray(len(blocks[0]) // piecesize * 32 * k)
+    for j in range(k):
+        for t in range(32):
+            out[32*j+t::32*k] = blocks[j][piecesize-32+t::piecesize]
+    return bytes(out)
+
+
+def decodeBlock(weights, blocks, moduloPrime, piecesize=33):
+    """
+    Decodes the blocks of pieces (one bytes object per fragment, in the
+    order of the weights) and returns the restored data.
+    """
+    if all(isinstance(row, integer_types) for row in weights):
+        return interleaveBlock([blocks[row] for row in weights], piecesize)
+    out = []
+    for i in range(0, len(blocks[0]), piecesize):
+        yValues = [bs.bytes2int(b[i:i+piecesize]) for b in blocks]
+        coefficients = interpolateChunk(weights, yValues, moduloPrime)
+        out.extend(bs.int2bytes(c, 32) for c in coefficients)
+    return b''.join(out)
+
+
+def createExecutor(workers):
+    """
+    Returns a process pool with 'workers' processes or None if the codec
+    should run serially.
+    """
+    if workers and workers > 1 and ProcessPoolExecutor is not None:
+        return ProcessPoolExecutor(workers)
+    return None
+
+
+def mapOrdered(executor, func, argsIterable, window):
+    """
+    Like map(func, *args) for every args of argsIterable, but the calls run
+    in the executor (if not None). At most 'window' calls are pending, the
+    results are yielded in order.
+    """
+    if executor is None:
+        for args in argsIterable:
+            yield func(*args)
+        return
+    pending = deque()
+    for args in argsIterable:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def hashLeaf(stripe):
+    """returns the Merkle leaf of a stripe of pieces"""
+    leaf = hashlib.sha256(b'\x00')
+    leaf.update(stripe)
+    return leaf.digest()
+
+
+def hashPair(left, right):
+    """returns the Merkle node of two child nodes"""
+    return hashlib.sha256(b''.join((b'\x01', left, right))).digest()
+
+
+def merkleLevels(leaves):
+    """
+    Returns all levels of the Merkle tree of 'leaves', from the leaves up to
+    the root. The last node of a level with an odd length is moved up.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([hashPair(level[i], level[i+1]) if i + 1 < len(level)
+                       else level[i] for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkleRoot(leaves):
+    """returns the Merkle root of 'leaves'"""
+    if not leaves:
+        return hashLeaf(b'')
+    return merkleLevels(leaves)[-1][0]
+
+
+def merkleProof(leaves, index, levels=None):
+    """
+    Returns the list of sibling hashes that prove the leaf at 'index'
+    (see verifyProof). levels can be passed to avoid recomputing the tree
+    (see merkleLevels).
+    """
+    proof = []
+    for level in (levels or merkleLevels(leaves))[:-1]:
+        if index ^ 1 < len(level):
+            proof.append(level[index ^ 1])
+        index //= 2
+    return proof
+
+
+def verifyProof(leaf, index, amount, proof, root):
+    """
+    Checks whether 'leaf' is the leaf at 'index' of the 'amount' leaves of
+    the Merkle tree with the root 'root'.
+    """
+    proof = list(proof)
+    node = leaf
+    while amount > 1:
+        if index ^ 1 < amount:
+            if not proof:
+                return False
+            sibling = proof.pop(0)
+            if index & 1:
+                node = hashPair(sibling, node)
+            else:
+                node = hashPair(node, sibling)
+        index //= 2
+        amount = (amount + 1) // 2
+    return not proof and node == root
+
+
+def stripeHashes(pieces, stripe=STRIPE, piecesize=33):
+    """returns the Merkle leaves of the bytes-like object pieces"""
+    stripeBytes = stripe * piecesize
+    return [hashLeaf(pieces[i:i+stripeBytes])
+            for i in range(0, len(pieces), stripeBytes)]
+
+
+class StripeHasher(object):
+    """
+    Computes the Merkle leaves of a stream of pieces, the same as
+    stripeHashes of the whole stream.
+    """
+    def __init__(self, stripe=STRIPE, piecesize=33):
+        self.stripeBytes = stripe * piecesize
+        self.leaves = []
+        self.current = None
+        self.filled = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if self.current is None:
+                self.current = hashlib.sha256(b'\x00')
+            n = min(self.stripeBytes - self.filled, len(data) - offset)
+            self.current.update(data[offset:offset+n])
+            self.filled += n
+            offset += n
+            if self.filled == self.stripeBytes:
+                self.leaves.append(self.current.digest())
+                self.current = None
+                self.filled = 0
+
+    def digest(self):
+        """returns the list of leaves"""
+        if self.current is not None:
+            return self.leaves + [self.current.digest()]
+        return self.leaves
+
+
+def verifyPieces(meta, pieces, leaves):
+    """
+    Checks the pieces of a fragment against its Merkle leaves and the leaves
+    against the root in meta. leaves is the concatenated trailer of the
+    fragment. Fragments without a root (json headers) can't be checked and
+    are accepted. The root is part of the same fragment, so this detects
+    corruption, not a forged fragment with a matching tree; that only the
+    hash of the restored file reveals (see restoreFile).
+    """
+    if "root" not in meta:
+        return True
+    leaves = memoryview(leaves).tobytes()
+    leaves = [leaves[i:i+32] for i in range(0, len(leaves), 32)]
+    if merkleRoot(leaves) != binascii.unhexlify(meta["root"]):
+        return False
+    return stripeHashes(pieces, meta["stripe"], meta["piecesize"]) == leaves
+
+
+def verifyFragmentData(data, meta):
+    """
+    Checks the fragment 'data' with the meta dictionary 'meta' (see
+    verifyPieces).
+    """
+    if "root" not in meta:
+        return True
+    end = HEADERSIZE + meta["pieces"] * meta["piecesize"]
+    data = memoryview(data)
+    return verifyPieces(meta, data[HEADERSIZE:end], data[end:])
+
+
+def verifyStripes(meta, firstPiece, pieces, proofs):
+    """
+    Checks the stripes of 'pieces', beginning with the piece 'firstPiece',
+    with their Merkle proofs against the root in meta (see getPieces). The
+    root is taken from the header, so this detects corrupted pieces but
+    can't replace the final check of the file hash.
+    """
+    stripe = meta["stripe"]
+    if firstPiece % stripe:
+        return False
+    amount = -(-meta["pieces"] // stripe)
+    leaves = stripeHashes(pieces, stripe, meta["piecesize"])
+    if len(leaves) != len(proofs):
+        return False
+    root = binascii.unhexlify(meta["root"])
+    return all(verifyProof(leaf, firstPiece // stripe + i, amount, proof, root)
+               for i, (leaf, proof) in enumerate(zip(leaves, proofs)))
+
+
+def isUploader(name):
+    """
+    True if name can be the folder of an uploader, that's a plain folder
+    name that isn't hidden or one of NOTUPLOADERS
+    """
+    return (bool(name) and name not in NOTUPLOADERS and
+            not name.startswith(".") and "/" not in name and
+            os.sep not in name)
+
+
+def storePath(meta):
+    """
+    returns the path of the payload of a convergent fragment in the content
+    addressed store, it's named after the Merkle root of the pieces
+    """
+    return STOREDIR + meta["root"]
+
+
+def isReference(meta, size):
+    """
+    True if a stored fragment of 'size' bytes is only the header of a
+    convergent fragment whose payload is in the store. Fragments with json
+    headers (version 0 and 1) have no "pieces" and are stored whole.
+    """
+    return (meta.get("convergent", False) and meta.get("pieces", 0) > 0 and
+            size == HEADERSIZE)
+
+
+def convergentXValues(hash, amount, start=1):
+    """
+    Derives 'amount' distinct x values >= start from the hex SHA256 of a
+    file, so that every upload of the file gets the same fragments.
+    """
+    xValues = []
+    counter = 0
+    while len(xValues) < amount:
+        digest = hashlib.sha256(b''.join((
+            b"x", binascii.unhexlify(hash), struct.pack("!I", counter)))).digest()
+        x = bs.bytes2int(digest[:8]) % (1000000000000000000 - start) + start
+        if x not in xValues:
+            xValues.append(x)
+        counter += 1
+    return xValues
+
+
+def convergentPadding(hash):
+    """
+    returns a function that returns n bytes of padding derived from the hex
+    SHA256 of a file (a replacement for os.urandom)
+    """
+    seed = hashlib.sha256(b"padding" + binascii.unhexlify(hash)).digest()
+    return lambda n: (seed * (n // len(seed) + 1))[:n]
+
+
+def compressor(codec):
+    """returns a streaming compressor (compress/flush) of the codec"""
+    if codec == "zlib":
+        return zlib.compressobj()
+    if codec == "bz2" and bz2 is not None:
+        return bz2.BZ2Compressor()
+    if codec == "lzma" and lzma is not None:
+        return lzma.LZMACompressor()
+    raise ValueError("Compression {} not supported".format(codec))
+
+
+def decompressor(codec):
+    """returns a streaming decompressor of the codec"""
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2" and bz2 is not None:
+        return bz2.BZ2Decompressor()
+    if codec == "lzma" and lzma is not None:
+        return lzma.LZMADecompressor()
+    raise ValueError("Compression {} not supported".format(codec))
+
+
+def decompressChunks(decompress, data, maxsize=2 ** 20):
+    """
+    Yields the data decompressed by the decompressor of decompressor() in
+    pieces of at most maxsize bytes, so that highly compressed data isn't
+    expanded in memory at once (except bz2 on Python 2, which can't limit
+    its output). Raises RuntimeError if data is corrupted.
+    """
+    # bz2 raises OSError (IOError on Python 2), the others their own errors
+    errors = (zlib.error, IOError, OSError, EOFError) + (
+        (lzma.LZMAError,) if lzma is not None else ())
+    try:
+        if not hasattr(decompress, "unconsumed_tail") and \
+                not hasattr(decompress, "needs_input"):
+            # Python 2
+            yield decompress.decompress(data)
+            return
+        out = decompress.decompress(data, maxsize)
+        while True:
+            if out:
+                yield out
+            if hasattr(decompress, "unconsumed_tail"):
+                # zlib keeps the input it didn't decompress yet
+                if not decompress.unconsumed_tail:
+                    return
+                out = decompress.decompress(decompress.unconsumed_tail,
+                                            maxsize)
+            elif decompress.needs_input or decompress.eof:
+                return
+            else:
+                out = decompress.decompress(b'', maxsize)
+    except errors:
+        raise RuntimeError("Compressed data is corrupted")
+
+
+def chooseCompression(filename, codec="zlib", samplesize=2 ** 16,
+                      ratio=0.9):
+    """
+    Compresses samples of the beginning, the middle and the end of the
+    file. Returns codec if they shrink to less than 'ratio' of their size,
+    else None (e.g. for encrypted or already compressed files).
     """
     size = os.path.getsize(filename)
-    toAdd = chunksize - (size % chunksize)
-    return toAdd
+    if codec is None or size == 0:
+        return None
+    sample = b''
+    with open(filename, 'rb') as f:
+        for offset in sorted(set((0, max(0, size // 2 - samplesize // 2),
+                                  max(0, size - samplesize)))):
+            f.seek(offset)
+            sample += f.read(samplesize)
+    c = compressor(codec)
+    compressed = c.compress(sample) + c.flush()
+    return codec if len(compressed) < ratio * len(sample) else None
 
 
 def checksumSha256(filename):
@@ -124,7 +838,7 @@ def checksumSha256(filename):
     """
     hash = hashlib.sha256()
     with open(filename, 'rb') as f:
-        for b in iter(partial(f.read, 2 ** 10), b''):
+        for b in iter(partial(f.read, 2 ** 16), b''):
             hash.update(b)
     return hash.hexdigest()
 
@@ -136,22 +850,291 @@ def allEqual(L):
     return L.count(L[0]) == len(L)
 
 
-def createPolynomials(file_, toAdd, chunksize=128, blocksize=32):
+def packHeader(meta, version=2, metaSize=None):
+    """
+    Returns the header of a fragment with the meta dictionary 'meta'.
+
+    Version 0 and 1 headers hold the meta as json. If metaSize is set, the
+    json is padded with spaces to that size.
+    Version 2 headers are binary (see BINARYHEADER), followed by the
+    uploader and padded with zeros to HEADERSIZE bytes, so that the pieces
+    are page aligned.
+    """
+    if version < 2:
+        meta = dict((key, value) for key, value in meta.items()
+                    if key not in ("version", "systematic", "pieces"))
+        meta = json.dumps(meta).encode()
+        if metaSize is not None:
+            assert len(meta) <= metaSize
+            meta += b' ' * (metaSize - len(meta))
+        return b''.join((b"#CL", bs.int2byte(version),
+                         bs.int2bytes(len(meta), 4), meta))
+    flags = 0
+    if meta.get("private"):
+        flags |= FLAGPRIVATE
+    if meta.get("systematic"):
+        flags |= FLAGSYSTEMATIC
+    if meta.get("convergent"):
+        flags |= FLAGCONVERGENT
+    flags |= COMPRESSIONS.index(meta.get("compression")) << COMPRESSIONSHIFT
+    uploader = meta.get("uploader", "").encode()
+    header = b''.join((BINARYHEADER.pack(
+        PREFIXES[2], meta["k"], meta.get("piecesize", 33), flags, meta["x"],
+        meta.get("pieces", 0), meta["added_bytes"],
+        binascii.unhexlify(meta["hash"]),
+        binascii.unhexlify(meta["filename"]),
+        binascii.unhexlify(meta.get("root", "0" * 64)),
+        meta.get("stripe", STRIPE), len(uploader)), uploader))
+    assert len(header) <= HEADERSIZE
+    return header + b'\x00' * (HEADERSIZE - len(header))
+
+
+def unpackBinaryHeader(header):
+    """
+    Returns the meta dictionary of the version 2 header 'header'.
+    """
+    (prefix, k, piecesize, flags, x, pieces, addedBytes, hash, filename,
+     root, stripe, n) = BINARYHEADER.unpack_from(header)
+    start = BINARYHEADER.size
+    return {
+        "version": 2,
+        "k": k,
+        "piecesize": piecesize,
+        "private": bool(flags & FLAGPRIVATE),
+        "systematic": bool(flags & FLAGSYSTEMATIC),
+        "convergent": bool(flags & FLAGCONVERGENT),
+        "compression": COMPRESSIONS[(flags >> COMPRESSIONSHIFT) & 3],
+        "x": x,
+        "pieces": pieces,
+        "added_bytes": addedBytes,
+        "hash": binascii.hexlify(hash).decode(),
+        "filename": binascii.hexlify(filename).decode(),
+        "root": binascii.hexlify(root).decode(),
+        "stripe": stripe,
+        "uploader": header[start:start+n].decode(),
+    }
+
+
+class FragmentFileWriter(object):
+    """
+    Buffered writer for a single fragment file. The header is only known
+    after the whole file is encoded, finish writes it over the placeholder
+    at the beginning of the file.
+    """
+    def __init__(self, filename, buffersize=2 ** 16):
+        self.filename = filename
+        self.file = open(filename, 'wb', buffersize)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def finish(self, header):
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+
+
+class FragmentEncoder(object):
+    """
+    Encodes a stream into one fragment per x value in a single pass. The data
+    is passed in arbitrary blocks with update, the pieces are written to the
+    writers (one per x value, see FragmentFileWriter) right away. finalize
+    pads the last chunk and writes the Merkle leaves (version 2) and the
+    final headers. Any 'threshold'
+    fragments allow to restore the data. If systematic is set, the
+    systematic code is used (see createFragments). If an executor is given,
+    the blocks are encoded in it, at most 'window' at a time. padding
+    returns the bytes to pad the last chunk with. If compression is set
+    (see COMPRESSIONS), the data is compressed before it's encoded, the hash
+    is the one of the uncompressed data.
+    """
+    def __init__(self, xValues, writers, meta, prime=2 ** 261 - 261,
+                 threshold=4, version=2, executor=None, window=2,
+                 systematic=False, padding=os.urandom, compression=None):
+        if systematic and version < 2:
+            version = 1
+        self.xValues = xValues
+        self.writers = writers
+        self.meta = meta.copy()
+        self.meta["k"] = threshold
+        self.meta["systematic"] = systematic
+        self.meta["compression"] = compression
+        self.compressor = compressor(compression) if compression else None
+        self.prime = prime
+        self.chunksize = 32 * threshold
+        self.version = version
+        self.executor = executor
+        self.window = window
+        self.padding = padding
+        self.pending = deque()
+        if systematic:
+            self.table = systematicTable(xValues, prime, threshold)
+        else:
+            self.table = powerTable(xValues, prime, threshold)
+        self.hash = hashlib.sha256()
+        self.rest = b''
+        self.pieces = 0
+        self.hashers = [StripeHasher() for x in xValues]
+        # placeholder headers with the maximal size of the final ones
+        self.metaSizes = []
+        for x, writer in zip(xValues, writers):
+            header = packHeader(self._meta(x, hash="0" * 64,
+                                           added_bytes=self.chunksize - 1),
+                                version)
+            self.metaSizes.append(len(header) - 8)
+            writer.write(header)
+
+    def _meta(self, x, **values):
+        meta = self.meta.copy()
+        meta["x"] = x
+        meta.update(values)
+        return meta
+
+    def _write(self, pieces):
+        for writer, hasher, b in zip(self.writers, self.hashers, pieces):
+            writer.write(b)
+            if self.version >= 2:
+                hasher.update(b)
+
+    def _encode(self, data):
+        """encodes data, len(data) has to be a multiple of the chunksize"""
+        if not data:
+            return
+        self.pieces += len(data) // self.chunksize
+        if self.executor is None:
+            self._write(encodeBlock(self.table, data, self.prime,
+                                    self.chunksize))
+            return
+        self.pending.append(self.executor.submit(
+            encodeBlock, self.table, data, self.prime, self.chunksize))
+        while len(self.pending) >= self.window:
+            self._write(self.pending.popleft().result())
+
+    def update(self, data):
+        self.hash.update(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        data = b''.join((self.rest, data))
+        usable = len(data) - len(data) % self.chunksize
+        self._encode(data[:usable])
+        self.rest = data[usable:]
+
+    def finalize(self):
+        """
+        Encodes the padded last chunk, writes the headers and returns the
+        hex SHA256 of the data.
+        """
+        if self.compressor is not None:
+            self.rest += self.compressor.flush()
+        addedBytes = -len(self.rest) % self.chunksize
+        if self.rest:
+            self._encode(self.rest + self.padding(addedBytes))
+        while self.pending:
+            self._write(self.pending.popleft().result())
+        hash = self.hash.hexdigest()
+        for x, writer, hasher, metaSize in zip(self.xValues, self.writers,
+                                               self.hashers, self.metaSizes):
+            meta = self._meta(x, hash=hash, added_bytes=addedBytes,
+                              pieces=self.pieces)
+            if self.version >= 2:
+                leaves = hasher.digest()
+                writer.write(b''.join(leaves))
+                meta["root"] = binascii.hexlify(merkleRoot(leaves)).decode()
+            writer.finish(packHeader(meta, self.version, metaSize))
+        return hash
+
+
+def readHeader(f):
+    """
+    Reads the header of the opened fragment f and returns the meta
+    dictionary, including the version of the header. Afterwards f points to
+    the first piece.
+    """
+    prefix = f.read(4)
+    if prefix not in PREFIXES:
+        raise RuntimeError("{} is not a Cirrolus fragment".format(
+            getattr(f, "name", "data")))
+    if prefix == PREFIXES[2]:
+        return unpackBinaryHeader(prefix + f.read(HEADERSIZE - 4))
+    metaSize = bs.bytes2int(f.read(4))
+    meta = json.loads(f.read(metaSize).decode())
+    meta["version"] = bs.byte2int(prefix, 3)
+    meta["systematic"] = meta["version"] == 1
+    meta.setdefault("k", 4)
+    meta.setdefault("private", False)
+    meta.setdefault("compression", None)
+    return meta
+
+
+def readMeta(file_):
     """
-    Creates a list of polynomes out of a file_
+    Returns the meta dictionary of the fragment file_ without reading the
+    pieces
     """
-    randomJunk = os.urandom(toAdd)
-    polynomes = []
-    coeff = []
     with open(file_, 'rb') as f:
-        for b in iter(partial(f.read, chunksize), b''):
-            if len(b) < 128:
-                b += randomJunk
-            for i in range(0, chunksize, blocksize):
-                coeff.append(bs.bytes2int(b[i:i+blocksize], 'big'))
-            polynomes.append(SimplePolynomial(coeff))
-            coeff = []
-    return polynomes
+        return readHeader(f)
+
+
+class MappedFragment(object):
+    """
+    Read-only memory map of the fragment file_. meta is the meta dictionary,
+    header the raw header, pieces a memoryview of the payload and leaves one
+    of the Merkle leaves,
+    therefore the pieces can be sliced without copying them. close has to be
+    called if the fragment isn't used as a context manager. Python 2 can't
+    view a memory map, there the fragment is read into memory instead.
+    """
+    def __init__(self, file_):
+        with open(file_, 'rb') as f:
+            self.meta = readHeader(f)
+            offset = f.tell()
+            f.seek(0)
+            self.header = f.read(offset)
+            if isReference(self.meta, os.fstat(f.fileno()).st_size):
+                # reference entry, the payload is in the store
+                with open(storePath(self.meta), 'rb') as payload:
+                    self.map = mmap.mmap(payload.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                offset = 0
+            else:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        piecesize = self.meta.get("piecesize", 33)
+        if "pieces" in self.meta:
+            end = offset + self.meta["pieces"] * piecesize
+        else:
+            end = offset + (len(self.map) - offset) // piecesize * piecesize
+        try:
+            view = memoryview(self.map)
+        except TypeError:
+            # Python 2
+            view = memoryview(bytearray(self.map[:]))
+        self.pieces = view[offset:end]
+        self.leaves = view[end:]
+
+    def verify(self):
+        """checks the pieces against the Merkle root (see verifyPieces)"""
+        return verifyPieces(self.meta, self.pieces, self.leaves)
+
+    def __len__(self):
+        """returns the amount of pieces"""
+        return len(self.pieces) // self.meta.get("piecesize", 33)
+
+    def close(self):
+        if hasattr(self.pieces, "release"):
+            self.pieces.release()
+            self.leaves.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # a slice of pieces is still referenced (e.g. by a traceback),
+            # the map is closed when it is garbage collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def readFragment(file_, piecesize=33):
@@ -159,15 +1142,12 @@ def readFragment(file_, piecesize=33):
     Reads the fragment file_ and returns the meta dictionary and a list of the y values
     """
     with open(file_, 'rb') as f:
-        if f.read(4) == b"#CL\x00":
-            metaSize = bs.bytes2int(f.read(4))
-            meta = json.loads(f.read(metaSize).decode())
-            y = []
-            for b in iter(partial(f.read, piecesize), b''):
-                y.append(bs.bytes2int(b))
-        else:
-            raise RuntimeError("{} is not a Cirrolus fragment".format(file_))
-    return (meta, y)
+        meta = readHeader(f)
+        y = []
+        for b in iter(partial(f.read, piecesize), b''):
+            y.append(bs.bytes2int(b))
+    # the Merkle leaves of version 2 fragments follow the pieces
+    return (meta, y[:meta.get("pieces", len(y))])
 
 
 def readListOfFragments(fragmentFilenames):
@@ -183,11 +1163,75 @@ def readListOfFragments(fragmentFilenames):
     return metas, pieceLists
 
 
+def readBlocks(file_, blocksize=2 ** 18, cipher=None):
+    """
+    Yields the blocks of the file file_, encrypted with cipher (see
+    readyAES.StreamEncryptor) if it's given.
+    """
+    with open(file_, 'rb') as f:
+        for b in iter(partial(f.read, blocksize), b''):
+            yield cipher.update(b) if cipher is not None else b
+    if cipher is not None:
+        yield cipher.finalize()
+
+
+def prefetch(iterable, maxsize=4):
+    """
+    Iterates over iterable in a thread and yields its items, at most
+    'maxsize' of them are buffered. Exceptions are reraised in the caller.
+    """
+    items = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for i in iterable:
+                items.put((True, i))
+            items.put((False, None))
+        except Exception as e:
+            items.put((False, e))
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    while True:
+        more, item = items.get()
+        if not more:
+            break
+        yield item
+    if item is not None:
+        raise item
+
+
 def createFragments(file_, amount, directory="cache/upload",
-                    prime=2 ** 261 - 261, chunksize=128, version=0,
-                    **meta):
+                    prime=2 ** 261 - 261, threshold=4, version=2,
+                    blocksize=2 ** 18, workers=None, systematic=False,
+                    convergent=False, compression=None, openWriter=None,
+                    cipher=None, **meta):
     """
-    Creates Fragments and returns a list of storage location
+    Creates Fragments and returns a list of storage location. Any
+    'threshold' of the 'amount' fragments allow to restore the file. The
+    file is read only once in blocks of 'blocksize' bytes, in a thread of
+    its own. If workers is greater than 1, the blocks are encoded by a pool
+    of that many processes.
+
+    If openWriter is given, it's called with every x value and returns the
+    writer of that fragment (see FragmentFileWriter), e.g. one that sends
+    it to a peer right away. The list of the writers is returned instead.
+    If cipher is given, the file is encrypted with it while it's read (see
+    readBlocks).
+
+    If systematic is set, the first 'threshold' fragments carry the blocks
+    of the file as they are. They can be restored without
+    interpolation, but they don't hide the content of the file. Use it only
+    for public or encrypted files.
+
+    If convergent is set, the x values and the padding are derived from the
+    hash of the file, hence every upload of the file creates the same
+    pieces and storage nodes keep them only once (see saveFragment). The
+    file has to be read twice for that.
+
+    If compression is set, the file is compressed with that codec (see
+    COMPRESSIONS and chooseCompression) before it's encoded. restoreFile
+    decompresses it again.
 
     meta:
     -----
@@ -195,79 +1239,222 @@ def createFragments(file_, amount, directory="cache/upload",
     uploader - Username of uploader
     private
     """
-    assert amount >= 4
-    makeDir(directory)
-    files = []
-    header = b"#CL" + bs.int2byte(version)
-    bytesToAdd = calcBytesToAdd(file_)
+    assert amount >= threshold >= 1
+    assert not (convergent and cipher)
     if "filename" not in meta:
         filename = os.path.split(file_)[-1].encode()
         meta["filename"] = hashlib.sha256(filename).hexdigest()
-    meta["added_bytes"] = bytesToAdd
-    meta["hash"] = checksumSha256(file_)
-    polynomes = createPolynomials(file_, bytesToAdd)
-    xValues = random.sample(range(1, 1000000000000000000), amount)
-    for x in xValues:
-        currentMeta = meta.copy()
-        currentMeta["x"] = x
-        currentMeta = json.dumps(currentMeta).encode()
-        currentMeta = b''.join((bs.int2bytes(len(currentMeta), 4), currentMeta))
-        pieces = b''
-        for i in range(len(polynomes)):
-            pieces += bs.int2bytes(polynomes[i](x, prime), 33)
-        tempFragmentName = "{}/{}".format(directory,
-                                          meta["filename"][:14] + str(x))
-        files.append(tempFragmentName)
-        with open(tempFragmentName, 'wb') as f:
-            f.write(b''.join((header, currentMeta, pieces)))
+    padding = os.urandom
+    if convergent:
+        meta["convergent"] = True
+        hash = checksumSha256(file_)
+        padding = convergentPadding(hash)
+        if systematic:
+            xValues = list(range(1, threshold + 1)) + convergentXValues(
+                hash, amount - threshold, threshold + 1)
+        else:
+            xValues = convergentXValues(hash, amount)
+    elif systematic:
+        xValues = list(range(1, threshold + 1)) + random.sample(
+            range(threshold + 1, 1000000000000000000), amount - threshold)
+    else:
+        xValues = random.sample(range(1, 1000000000000000000), amount)
+    if openWriter is None:
+        makeDir(directory)
+        files = ["{}/{}".format(directory, meta["filename"][:14] + str(x))
+                 for x in xValues]
+        writers = [FragmentFileWriter(i) for i in files]
+    else:
+        files = writers = [openWriter(x) for x in xValues]
+    executor = createExecutor(workers)
+    try:
+        encoder = FragmentEncoder(xValues, writers, meta, prime, threshold,
+                                  version, executor, 2 * (workers or 1),
+                                  systematic, padding, compression)
+        for b in prefetch(readBlocks(file_, blocksize, cipher)):
+            encoder.update(b)
+        encoder.finalize()
+    finally:
+        if executor is not None:
+            executor.shutdown()
     return files
 
 
+def fileSize(meta):
+    """
+    returns the size of the file of a fragment with a version 2 header, of
+    the compressed file if it's compressed
+    """
+    return meta["pieces"] * 32 * meta["k"] - meta["added_bytes"]
+
+
+def chunkRange(meta, start, end):
+    """
+    Returns the range [i, j) of the chunks, hence the pieces of every
+    fragment, that hold the bytes [start, end) of the file of meta.
+    """
+    chunksize = 32 * meta["k"]
+    end = min(end, fileSize(meta))
+    start = min(start, end)
+    return start // chunksize, -(-end // chunksize)
+
+
+def decodingWeights(metas, prime):
+    """
+    Returns the weights to decode the chunks of the fragments with the meta
+    dictionaries 'metas' (see interpolateChunk).
+    """
+    xValues = [i["x"] for i in metas]
+    if metas[0]["systematic"]:
+        return systematicWeights(xValues, prime)
+    return interpolationWeights(xValues, prime)
+
+
+def restoreFile(fragmentFilenames, output, prime=2 ** 261 - 261,
+                blocksize=2 ** 12, workers=None):
+    """
+    Restores the file of the fragments given and writes it to output, a
+    filename or a file-like object. The fragments are memory mapped and
+    read in lockstep, 'blocksize' chunks at a time. If workers is greater
+    than 1, the blocks are decoded by a pool of that many processes. Returns
+    the meta dictionary. The threshold k is read from the meta of the first
+    fragment, the first k fragments that pass verifyPieces are used. For
+    systematic fragments, the data fragments are preferred, if all of them
+    are given, the data is only concatenated. Compressed files are
+    decompressed on the fly. A RuntimeError is raised if the restored data
+    doesn't match the hash of the file or can't be decoded.
+    """
+    meta = readMeta(fragmentFilenames[0])
+    k = meta["k"]
+    if meta["systematic"]:
+        fragmentFilenames = sorted(fragmentFilenames,
+                                   key=lambda i: readMeta(i)["x"] > k)
+    fragments = []
+    sink = None
+    executor = createExecutor(workers)
+    try:
+        for i in fragmentFilenames:
+            if len(fragments) == k:
+                break
+            fragment = MappedFragment(i)
+            if fragment.verify():
+                fragments.append(fragment)
+            else:
+                fragment.close()
+        if len(fragments) < k:
+            raise RuntimeError("Not enough fragments - {} needed".format(k))
+        metas = [f.meta for f in fragments]
+        if not allEqual([(i["hash"], i["version"]) for i in metas]):
+            raise RuntimeError("Fragments don't belong together - unequal hashes")
+        if not allEqual([len(f) for f in fragments]):
+            raise RuntimeError("Fragments don't belong together - unequal sizes")
+        weights = decodingWeights(metas, prime)
+        piecesize = metas[0].get("piecesize", 33)
+        # the process pool needs picklable blocks, else they are views
+        # (Python 2 can't decode views either)
+        if executor is not None or sys.version < '3':
+            copy = lambda b: b.tobytes()
+        else:
+            copy = lambda b: b
+        amountBlocks = -(-len(fragments[0]) // blocksize)
+        blocks = ((weights,
+                   [copy(f.pieces[i*blocksize*piecesize:
+                                  (i+1)*blocksize*piecesize])
+                    for f in fragments],
+                   prime, piecesize) for i in range(amountBlocks))
+        sink = output if hasattr(output, "write") else open(output, 'wb')
+        window = 2 * (workers or 1)
+        hash = hashlib.sha256()
+        codec = metas[0].get("compression")
+        decompress = decompressor(codec) if codec else None
+        for i, out in enumerate(mapOrdered(executor, decodeBlock, blocks,
+                                           window)):
+            if i == amountBlocks - 1:
+                out = out[:len(out) - metas[0]["added_bytes"]]
+            for out in (decompressChunks(decompress, out)
+                        if decompress is not None else (out,)):
+                hash.update(out)
+                sink.write(out)
+        if codec == "zlib":
+            out = decompress.flush()
+            hash.update(out)
+            sink.write(out)
+        if hash.hexdigest() != metas[0]["hash"]:
+            raise RuntimeError("Restored file doesn't match its hash")
+    except ArithmeticError:
+        # forged pieces can decode to numbers larger than a chunk
+        raise RuntimeError("Fragments can't be decoded")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for f in fragments:
+            f.close()
+        if sink is not None and sink is not output:
+            sink.close()
+    return metas[0]
+
+
+def restoreRange(parts, start, end, prime=2 ** 261 - 261):
+    """
+    Restores the bytes [start, end) of a file. parts is a list of
+    (meta, index of the first piece, pieces) of at least k fragments of the
+    file that cover the chunks of the range (see chunkRange and getPieces).
+    """
+    meta = parts[0][0]
+    k = meta["k"]
+    if meta["systematic"]:
+        parts = sorted(parts, key=lambda i: i[0]["x"] > k)
+    parts = parts[:k]
+    if len(parts) < k:
+        raise RuntimeError("Not enough fragments - {} needed".format(k))
+    if not allEqual([i[0]["hash"] for i in parts]):
+        raise RuntimeError("Fragments don't belong together - unequal hashes")
+    piecesize = meta["piecesize"]
+    first, last = chunkRange(meta, start, end)
+    blocks = []
+    for partMeta, firstPiece, pieces in parts:
+        block = pieces[(first - firstPiece) * piecesize:
+                       (last - firstPiece) * piecesize]
+        if firstPiece > first or len(block) != (last - first) * piecesize:
+            raise RuntimeError("Pieces don't cover the range")
+        blocks.append(block)
+    data = decodeBlock(decodingWeights([i[0] for i in parts], prime), blocks,
+                       prime, piecesize)
+    start = min(start, fileSize(meta))
+    offset = start - first * 32 * k
+    return data[offset:offset + min(end, fileSize(meta)) - start]
+
+
 def combineFragments(fragmentFilenames, prime=2 ** 261 - 261):
     """
     Combines all fragments given to the file they represent.
     returns file and a boolean if it's a private/encrypted file
     """
-    assert len(fragmentFilenames) >= 4
-    metas, yLists = readListOfFragments(fragmentFilenames)
-    if not allEqual([i["hash"] for i in metas]):
-        raise RuntimeError("Fragments don't belong together - unequal hashes")
-    n = len(yLists[0])
-    out = []
-    for i in range(n):
-        coordinates = [(metas[j]["x"], yLists[j][i]) for j in range(len(yLists))]
-        polynom = lagrange(coordinates, prime)
-        out.extend(polynom.coefficients)
-    out = [bs.int2bytes(i, 32) for i in out]
-    out = b''.join(out)
-    try:
-        private = metas[0]["private"]
-    except KeyError:
-        private = False
-    return (out[:-metas[0]["added_bytes"]], private)
+    out = io.BytesIO()
+    meta = restoreFile(fragmentFilenames, out, prime)
+    return (out.getvalue(), meta.get("private", False))
 
 
 if __name__ == '__main__':
-    import sys
     import time
 
     usage = """Usage: {} [OPTION] ...
 
-Split File:
-    -s FILE
+Split File into N fragments, any K of them restore it (default 4 4):
+    -s FILE [N K]
 Restore:
-    -c OUTPUT F1 F2 F3 F4
+    -c OUTPUT F1 ... FK
 """.format(sys.argv[0])
 
     try:
-        if sys.argv[1].lower() == '-s' and len(sys.argv) == 3:
-            createFragments(sys.argv[2], 4, uploader="test")
-        elif sys.argv[1].lower() == '-c' and len(sys.argv) == 7:
+        if sys.argv[1].lower() == '-s' and len(sys.argv) in (3, 5):
+            amount, threshold = map(int, sys.argv[3:5] or (4, 4))
+            createFragments(sys.argv[2], amount, uploader="test",
+                            threshold=threshold)
+        elif sys.argv[1].lower() == '-c' and len(sys.argv) >= 4:
             start = time.time()
-            data, private = combineFragments(sys.argv[3:])
+            restoreFile(sys.argv[3:], sys.argv[2])
             print("Time: ", time.time() - start)
-            with open(sys.argv[2], 'wb') as f:
-                f.write(data)
         else:
             print(usage)
     except IndexError:
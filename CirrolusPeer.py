@@ -4,6 +4,7 @@
 #
 from __future__ import print_function
 import logging
+import os
 import socket
 import select
 import struct
@@ -12,9 +13,41 @@ import threading
 import time
 import binascii
 import json
+from collections import deque
 import bytesSupport as bs
 import CirrolusFiles as cf
 from py2_3 import *
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import selectors
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    selectors = None
+
+# streamed fragments are received in this folder (see _handleUploadStream0)
+INCOMING = "./cache/incoming/"
+# largest block of a streamed fragment
+MAXBLOCK = 2 ** 24
+# messages that aren't received completely (see receive), their handlers
+# read the payload from the connection
+STREAMEDIDS = (3, 6, 11)
+# messages that transfer fragments, the server handles them in a pool of
+# their own, so that they can't occupy the workers of the others
+BULKIDS = (3, 5, 9, 11)
+# header of version 1 messages: prefix, version, message ID, tag (echoed in
+# the reply), length of the payload
+FRAMEHEADER = struct.Struct("!2sBBII")
+# largest payload of a message, by message ID; the others are control
+# messages of at most MAXCONTROL bytes. Fragments (3 and 6 are streamed,
+# see STREAMEDIDS) and pieces may be as large as the length fields allow.
+MAXSIZE = 2 ** 32 - 1
+MAXPAYLOAD = {2: 2 ** 16, 3: MAXSIZE, 6: MAXSIZE, 8: 2 ** 16, 10: MAXSIZE}
+MAXCONTROL = 2 ** 12
+# larger messages aren't preallocated, their buffer grows as they arrive
+PREALLOCATE = 2 ** 16
 
 
 class CirrolusPeerCore(object):
@@ -30,6 +63,24 @@ class CirrolusPeerCore(object):
         # that includes all the different message IDs and their function
         self.versionHandlers = {}
         self.buffersize = 4096
+        # seconds a receiving connection may be idle in a message
+        self.idleTimeout = 30
+        # pending connections of the server, threads handling messages
+        self.backlog = 128
+        self.workers = 16
+        self.bulkWorkers = 16
+        # seconds a version 1 connection is kept open for further messages,
+        # by the server and by the pool of channels to other peers (less)
+        self.keepAlive = 120
+        self.channelIdle = 90
+        self.channels = {}
+        self.channelLock = threading.Lock()
+        # versions the peers were reached with, peers of version 0 don't
+        # understand version 1 messages (see peerVersion)
+        self.peerVersions = {}
+        # version and tag of the message that is handled by a thread, the
+        # replies use them (see handleAccordingly)
+        self.local = threading.local()
         self.fileManager = cf.FragmentManager()
         self.logger = logger or logging.getLogger(__name__)
 
@@ -39,19 +90,47 @@ class CirrolusPeerCore(object):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.server.listen(self.backlog)
         self.logger.info("Server started")
 
-    def _handlePeer(self, connection):
+    def _handlePeer(self, connection, timeout=4, bulk=None):
         """
-        Handles the event if a peer connects to the server
+        Handles the event if a peer connects to the server or sends its next
+        message. Returns True if the connection is kept open for further
+        messages, that's the case after version 1 messages, else it's closed.
+        If bulk is set, messages in BULKIDS are passed on with
+        bulk(connection, message) instead and None is returned.
         """
-        self.logger.info("Process started: {}".format(threading.current_thread().name))
-        self.logger.info("Connected: {}".format(connection.getpeername()))
+        try:
+            self.logger.info("Process started: {}".format(threading.current_thread().name))
+            self.logger.info("Connected: {}".format(connection.getpeername()))
 
-        message = self.receive(connection)
-        self.handleAccordingly(connection, message)
-        connection.close()
+            message = self.receive(connection, timeout)
+        except Exception:
+            self.logger.error("Unknown error", exc_info=True)
+            connection.close()
+            return False
+        if (bulk is not None and len(message) > 3 and
+                bs.byte2int(message, 3) in BULKIDS):
+            bulk(connection, message)
+            return None
+        return self._handleMessage(connection, message)
+
+    def _handleMessage(self, connection, message):
+        """
+        Handles the received message (see handleAccordingly) and closes the
+        connection unless it's kept open, then True is returned.
+        """
+        keep = False
+        try:
+            keep = (self.handleAccordingly(connection, message) and
+                    bs.byte2int(message, 2) != 0 and self.running)
+        except Exception:
+            self.logger.error("Unknown error", exc_info=True)
+        finally:
+            if not keep:
+                connection.close()
+        return keep
 
     def handleAccordingly(self, connection, message, expectedId=None):
         """
@@ -68,13 +147,22 @@ class CirrolusPeerCore(object):
             self.logger.debug("""
                 Version: {}
                 ID: {}
-                Payload: {}""".format(version, messageId, payload))
+                Payload: {}""".format(version, messageId, payload[:64]))
+            # a handled request is replied to in its version
+            isRequest = expectedId is None
+            if isRequest:
+                self.local.version = version
+                if version:
+                    self.local.tag = FRAMEHEADER.unpack_from(message)[3]
             try:
                 if messageId == expectedId or expectedId is None:
                     self.versionHandlers[version][messageId](connection, payload)
                     handlerFound = True
             except KeyError:
                 pass
+            finally:
+                if isRequest:
+                    self.local.__dict__.clear()
         return handlerFound
 
     def addPeer(self, peer):
@@ -95,6 +183,120 @@ class CirrolusPeerCore(object):
             self.logger.info("remove {} from {}".format(peer, self.peers))
             with self.lock:
                 del self.peers[self.peers.index(peer)]
+        self.dropChannel(peer)
+
+    def getChannel(self, peer):
+        """
+        Returns the pooled channel to peer, a new one if there is none or it
+        was closed. Channels that were idle for self.channelIdle seconds are
+        closed. Raises ConnectionRefusedError if peer can't be reached.
+        """
+        now = time.time()
+        with self.channelLock:
+            for i in [i for i, c in self.channels.items()
+                      if now - c.lastUsed > self.channelIdle and not c.pending]:
+                self.channels.pop(i).close()
+            channel = self.channels.get(peer)
+            if channel is not None and channel.isStale():
+                del self.channels[peer]
+                channel.close()
+                channel = None
+        if channel is None:
+            new = Channel(self, peer)
+            with self.channelLock:
+                channel = self.channels.setdefault(peer, new)
+            if channel is not new:
+                new.close()
+        return channel
+
+    def dropChannel(self, peer, channel=None):
+        """Closes the pooled channel to peer (only if it's channel)"""
+        with self.channelLock:
+            if peer in self.channels and channel in (None, self.channels[peer]):
+                self.channels.pop(peer).close()
+
+    def closeChannels(self):
+        with self.channelLock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels.clear()
+
+    def peerVersion(self, peer):
+        """
+        Returns the version of the messages to peer. Peers whose version
+        isn't known yet get self.version, if such a peer closes the
+        connection without a reply, it's asked again with version 0 (see
+        request and openRequest). The version that was answered is kept.
+        """
+        return self.peerVersions.get(peer, self.version)
+
+    def request(self, peer, messageId, payload=b'', timeout=4, reply=True):
+        """
+        Sends a message to peer over the pooled channel and returns the
+        reply, b'' if none arrives in timeout seconds. If reply isn't set,
+        it doesn't wait for one. Raises ConnectionRefusedError if peer can't
+        be reached. Bulk transfers use connections of their own instead.
+        Version 0 peers get the message over a connection of its own, so do
+        peers of unknown version if there's no reply to tell.
+        """
+        version = self.peerVersion(peer)
+        if version == 0 or (not reply and peer not in self.peerVersions):
+            return self._request0(peer, messageId, payload, timeout, reply)
+        channel = self.getChannel(peer)
+        message = channel.request(messageId, payload, timeout, reply)
+        if channel.broken:
+            self.dropChannel(peer, channel)
+            if not message and peer not in self.peerVersions:
+                message = self._request0(peer, messageId, payload, timeout,
+                                         reply)
+                if message:
+                    self.peerVersions[peer] = 0
+        elif message and version:
+            self.peerVersions[peer] = version
+        return message
+
+    def _request0(self, peer, messageId, payload, timeout, reply):
+        """like request, with a version 0 message"""
+        connection = self.connectToServer(peer)
+        try:
+            self.send(connection, messageId, payload, 0)
+            return self.receive(connection, timeout) if reply else b''
+        finally:
+            connection.close()
+
+    def openRequest(self, peer, messageId, payload=b'', timeout=4,
+                    active=None):
+        """
+        Sends a message to peer over a connection of its own, as bulk
+        transfers do, and receives the reply (see receive). Returns the
+        connection, which has to be closed, and the reply. The connection is
+        in the set 'active' while it's used. A peer of unknown version that
+        closes the connection without a reply is asked again with version 0
+        (see peerVersion). Raises ConnectionRefusedError.
+        """
+        version = self.peerVersion(peer)
+        # nothing is learned if version 0 is all this peer speaks anyway
+        known = not version or peer in self.peerVersions
+        while True:
+            connection = self.connectToServer(peer)
+            if active is not None:
+                active.add(connection)
+            start = time.time()
+            try:
+                self.send(connection, messageId, payload, version)
+                reply = self.receive(connection, timeout)
+            except socket.error:
+                # closed while it was sending
+                reply = b''
+            if reply and not known:
+                self.peerVersions[peer] = version
+            if (reply or known or not version or
+                    time.time() - start >= timeout):
+                return connection, reply
+            if active is not None:
+                active.discard(connection)
+            connection.close()
+            version = 0
 
     def isCirrolus(self, message):
         try:
@@ -106,14 +308,29 @@ class CirrolusPeerCore(object):
         else:
             return False
 
-    def packMessage(self, version, messageId, payload=b''):
-        message = b''.join((b'CL', bs.int2byte(version), bs.int2byte(messageId), payload))
-        return message
+    def packMessage(self, version, messageId, payload=b'', tag=0):
+        """
+        Version 0:
+        |CL| |version| |message ID| |payload|
+         2B      1B         1B
+        Version 1 (see FRAMEHEADER):
+        |CL| |version| |message ID| |tag| |length| |payload|
+         2B      1B         1B        4B     4B
+        """
+        return b''.join((self.packMessageHeader(version, messageId,
+                                                len(payload), tag), payload))
+
+    def packMessageHeader(self, version, messageId, size, tag=0):
+        """returns the beginning of a message with a payload of size bytes"""
+        if version == 0:
+            return b''.join((b'CL', bs.int2byte(version),
+                             bs.int2byte(messageId)))
+        return FRAMEHEADER.pack(b'CL', version, messageId, tag, size)
 
     def unpackMessage(self, message):
         version = bs.byte2int(message, 2)
         messageId = bs.byte2int(message, 3)
-        payload = message[4:]
+        payload = message[4 if version == 0 else FRAMEHEADER.size:]
         return version, messageId, payload
 
     def connectToServer(self, peer):
@@ -122,11 +339,18 @@ class CirrolusPeerCore(object):
         connection.connect(peer)
         return connection
 
-    def send(self, connection, messageId, payload):
+    def send(self, connection, messageId, payload, version=None):
         """
         Sends a Cirrolus message to the peer that is connected to connection.
+        A reply has the version and the tag of the message handled, other
+        messages 'version' (self.version if it's None).
         """
-        msg = self.packMessage(self.version, messageId, payload)
+        if version is None:
+            version = getattr(self.local, "version", self.version)
+            tag = getattr(self.local, "tag", 0)
+        else:
+            tag = 0
+        msg = self.packMessage(version, messageId, payload, tag)
         try:
             connection.sendall(msg)
             self.logger.info("Send something")
@@ -134,31 +358,128 @@ class CirrolusPeerCore(object):
         except BrokenPipeError:
             self.logger.info("Sendig failed")
 
+    def sendFiles(self, connection, messageId, prefix, parts):
+        """
+        Sends a message like send, its payload is prefix followed by the
+        parts (filename, offset, size) of files. The files are sent with
+        socket.sendfile, hence straight from the page cache.
+        """
+        size = len(prefix) + sum(i[2] for i in parts)
+        connection.sendall(self.packMessageHeader(
+            getattr(self.local, "version", self.version), messageId, size,
+            getattr(self.local, "tag", 0)) + prefix)
+        for filename, offset, count in parts:
+            with open(filename, 'rb') as f:
+                if hasattr(connection, "sendfile"):
+                    connection.sendfile(f, offset, count)
+                else:
+                    f.seek(offset)
+                    while count > 0:
+                        b = f.read(min(count, 2 ** 16))
+                        if not b:
+                            raise IOError("File truncated")
+                        connection.sendall(b)
+                        count -= len(b)
+        self.logger.info("Send files")
+
+    def _recvInto(self, connection, view, deadline=None):
+        """
+        Fills the memoryview 'view' with data of connection. Every recv
+        blocks until the deadline (time.time()) or for self.idleTimeout
+        seconds. Raises IOError if the connection is closed or times out.
+        """
+        while len(view):
+            if deadline is None:
+                connection.settimeout(self.idleTimeout)
+            else:
+                connection.settimeout(max(deadline - time.time(), 0.001))
+            n = connection.recv_into(view)
+            if not n:
+                raise IOError("Connection closed")
+            view = view[n:]
+
+    def _recvGrowing(self, connection, message, size):
+        """
+        Appends size bytes of connection to the bytearray message, which
+        grows as they arrive instead of being allocated for a size the peer
+        only claims. Raises IOError like _recvInto.
+        """
+        end = len(message) + size
+        connection.settimeout(self.idleTimeout)
+        while len(message) < end:
+            data = connection.recv(min(end - len(message), 2 ** 20))
+            if not data:
+                raise IOError("Connection closed")
+            message += data
+        return message
+
     def receive(self, connection, timeout=4):
         """
         Waits timeout seconds for a message from the peer connected to
-        connection and returns the data. If message is sent during timeout
-        an empty byte is returned (b'').
-        """
-        connection.setblocking(0)  # make sure that recv never blocks for ever
-        ready = select.select([connection], [], [], timeout)
-        data = b''
-        if ready[0]:
-            data = connection.recv(self.buffersize)
-            if len(data) > 1024:    # this means it isn't a small msg
-                if self.isCirrolus(data):
-                    version, messageId, payload = self.unpackMessage(data)
-                    # only those messages have the size at this position
-                    if messageId in (3, 6, 8):
-                        size = struct.unpack("!I", payload[:4])[0]
-                        # len(data) - 8 because: prefix + 4 bytes for size = 8
-                        while size > (len(data) - 8):
-                            try:
-                                data += connection.recv(self.buffersize)
-                            except socket.error:    # OS X may raise Error
-                                pass
-                        data = data[:size + 8]
-        connection.setblocking(1)  # go back to blocking mode
+        connection and returns the data. Version 1 messages are read
+        completely according to the length in their header, if it's within
+        the limit of their ID (see MAXPAYLOAD), the connection may be idle
+        for self.idleTimeout seconds meanwhile. Of messages in STREAMEDIDS
+        only the header and the size at the beginning of the payload are
+        read (version 1) or what has arrived yet (version 0), so that large
+        fragments don't have to fit into memory.
+        If no message is sent during timeout or the connection breaks, an
+        empty byte is returned (b'').
+        """
+        deadline = time.time() + timeout
+        try:
+            # prefix and version, a version 0 message must not be waited
+            # for longer than it is
+            header = bytearray(FRAMEHEADER.size)
+            self._recvInto(connection, memoryview(header)[:3], deadline)
+            if bs.byte2int(header, 2) == 0:
+                return self._receive0(connection, bytes(header[:3]))
+            self._recvInto(connection, memoryview(header)[3:], deadline)
+            prefix, version, messageId, tag, size = FRAMEHEADER.unpack(
+                bytes(header))
+            if (prefix != b"CL" or
+                    size > MAXPAYLOAD.get(messageId, MAXCONTROL)):
+                return b''
+            if messageId in STREAMEDIDS:
+                message = header + bytearray(min(size, 4))
+                self._recvInto(connection,
+                               memoryview(message)[FRAMEHEADER.size:])
+                return message
+            if size > PREALLOCATE:
+                return self._recvGrowing(connection, header, size)
+            message = bytearray(FRAMEHEADER.size + size)
+            message[:FRAMEHEADER.size] = header
+            self._recvInto(connection,
+                           memoryview(message)[FRAMEHEADER.size:])
+            return message
+        except (IOError, socket.error):
+            return b''
+        finally:
+            try:
+                connection.settimeout(None)
+            except socket.error:
+                pass
+
+    def _receive0(self, connection, head=b''):
+        """
+        Receives a version 0 message that begins with the already received
+        bytes head, they only have their size in the payload if they are
+        large.
+        """
+        connection.settimeout(self.idleTimeout)
+        data = head + connection.recv(self.buffersize - len(head))
+        if len(data) > 1024:    # this means it isn't a small msg
+            if self.isCirrolus(data):
+                version, messageId, payload = self.unpackMessage(data)
+                # only those messages have the size at this position,
+                # streamed ones are read by their handler
+                if messageId in (8, 10):
+                    size = struct.unpack("!I", payload[:4])[0]
+                    if size > MAXPAYLOAD[messageId]:
+                        return b''
+                    # prefix + 4 bytes for size = 8
+                    data = bytearray(data[:size + 8])
+                    self._recvGrowing(connection, data, size + 8 - len(data))
         return data
 
     def getRandomPeers(self, n):
@@ -170,31 +491,434 @@ class CirrolusPeerCore(object):
         """
         self.run() will start a server and will listen on the address of
         the object.
-        It will run as long as self.running is True. If a client connects,
-        a new thread that handles the peer starts -> self._handlePeer
+        It will run as long as self.running is True. If a client sends a
+        message, it's handled by a worker thread -> self._handlePeer
+        Without the selectors module, a new thread is started for every
+        client instead. The index of the saved fragments is built first.
         """
+        self.fileManager.loadIndex()
         self._startserver()
         self.running = True
+        try:
+            if selectors is None:
+                self._runThreaded()
+            else:
+                self._runSelector()
+        finally:
+            self.server.close()
+            self.closeChannels()
+        self.logger.info("Stopped listening")
+
+    def _runSelector(self):
+        """
+        Waits for new connections and their messages with a selector, only
+        then the connection is passed to one of self.workers threads.
+        Therefore idle connections don't need a thread. Transfers of
+        fragments (BULKIDS) are handled by one of self.bulkWorkers other
+        threads, so slow ones don't delay the other messages. Kept-alive
+        connections are handed back through 'returned' and wake up the
+        selector. New connections that don't send anything for
+        self.idleTimeout seconds are closed, kept-alive ones after
+        self.keepAlive seconds.
+        """
+        selector = selectors.DefaultSelector()
+        executor = ThreadPoolExecutor(self.workers)
+        bulkExecutor = ThreadPoolExecutor(self.bulkWorkers)
+        wakeupReader, wakeupWriter = socket.socketpair()
+        returned = deque()
+
+        def giveBack(connection):
+            returned.append(connection)
+            wakeupWriter.send(b'\x00')
+
+        def serveBulk(connection, message):
+            if self._handleMessage(connection, message):
+                giveBack(connection)
+
+        def bulk(connection, message):
+            bulkExecutor.submit(serveBulk, connection, message)
+
+        def serve(connection):
+            if self._handlePeer(connection, bulk=bulk):
+                giveBack(connection)
+
+        self.server.setblocking(False)
+        selector.register(self.server, selectors.EVENT_READ)
+        selector.register(wakeupReader, selectors.EVENT_READ)
+        waiting = {}    # connection: time it's closed if it stays silent
+        try:
+            while self.running:
+                for key, events in selector.select(1):
+                    if key.fileobj is self.server:
+                        try:
+                            connection, clientaddress = self.server.accept()
+                        except socket.error:
+                            continue
+                        connection.setblocking(True)
+                        selector.register(connection, selectors.EVENT_READ)
+                        waiting[connection] = time.time() + self.idleTimeout
+                    elif key.fileobj is wakeupReader:
+                        wakeupReader.recv(4096)
+                        while returned:
+                            connection = returned.popleft()
+                            selector.register(connection, selectors.EVENT_READ)
+                            waiting[connection] = time.time() + self.keepAlive
+                    else:
+                        selector.unregister(key.fileobj)
+                        del waiting[key.fileobj]
+                        executor.submit(serve, key.fileobj)
+                now = time.time()
+                for connection in [i for i in waiting if waiting[i] < now]:
+                    selector.unregister(connection)
+                    del waiting[connection]
+                    connection.close()
+        finally:
+            executor.shutdown(wait=False)
+            bulkExecutor.shutdown(wait=False)
+            for connection in list(waiting) + list(returned):
+                connection.close()
+            selector.close()
+            wakeupReader.close()
+            wakeupWriter.close()
+
+    def _runThreaded(self):
         self.server.settimeout(2)
         while self.running:
             try:
                 connection, clientaddress = self.server.accept()
-                thread = threading.Thread(target=self._handlePeer, args=(connection,))
+                thread = threading.Thread(target=self._handleConnection,
+                                          args=(connection,))
                 thread.start()
             except socket.timeout:
                 pass
             except Exception:
                 self.logger.error("Unknown error", exc_info=True)
 
-        self.server.close()
-        self.logger.info("Stopped listening")
+    def _handleConnection(self, connection):
+        """Handles the messages of a connection until it's closed"""
+        timeout = 4
+        while self._handlePeer(connection, timeout):
+            timeout = self.keepAlive
+
+
+class Channel(object):
+    """
+    Kept-alive version 1 connection to peer (see CirrolusPeerCore.request).
+    Several threads can send requests over it at the same time, the replies
+    are told apart by their tags (the peer handles them in order). Only one
+    thread reads from the connection at a time, it passes the replies of the
+    others on. If a reply doesn't arrive in time, only its request fails, a
+    late reply is dropped. If the connection breaks, the channel is broken.
+    """
+    def __init__(self, peerObject, peer):
+        self.peerObject = peerObject
+        self.peer = peer
+        self.connection = peerObject.connectToServer(peer)
+        self.sendLock = threading.Lock()
+        self.condition = threading.Condition()
+        self.tag = 0
+        self.replies = {}
+        self.pending = 0
+        self.reading = False
+        self.broken = False
+        self.lastUsed = time.time()
+
+    def isStale(self):
+        """True if the channel is broken or closed by the peer"""
+        with self.condition:
+            if self.broken or self.pending:
+                return self.broken
+            # an idle connection is only readable if it was closed
+            return bool(select.select([self.connection], [], [], 0)[0])
+
+    def close(self):
+        self.broken = True
+        try:
+            self.connection.close()
+        except socket.error:
+            pass
+
+    def request(self, messageId, payload=b'', timeout=4, reply=True):
+        """
+        Sends a message and returns the reply, b'' if none arrives in
+        timeout seconds. If reply isn't set, it doesn't wait for one.
+        """
+        with self.condition:
+            self.tag = self.tag % 0xffffffff + 1
+            tag = self.tag
+            self.pending += 1
+            if reply:
+                self.replies[tag] = None
+        try:
+            with self.sendLock:
+                self.connection.sendall(self.peerObject.packMessage(
+                    1, messageId, payload, tag))
+            if reply:
+                self._wait(tag, time.time() + timeout)
+        except socket.error:
+            self.broken = True
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.lastUsed = time.time()
+                message = self.replies.pop(tag, None)
+        return message or b''
+
+    def _wait(self, tag, deadline):
+        """waits for the reply with the tag 'tag', or reads it itself"""
+        with self.condition:
+            while self.replies[tag] is None and not self.broken:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                elif self.reading:
+                    self.condition.wait(remaining)
+                else:
+                    self.reading = True
+                    self.condition.release()
+                    try:
+                        message = self._read(remaining)
+                    finally:
+                        self.condition.acquire()
+                        self.reading = False
+                    if message is None:
+                        pass
+                    elif message and bs.byte2int(message, 2) != 0:
+                        other = FRAMEHEADER.unpack_from(message)[3]
+                        if other in self.replies:
+                            self.replies[other] = message
+                    else:
+                        self.broken = True
+                    self.condition.notify_all()
+
+    def _read(self, timeout):
+        """
+        Returns the next message, None if none begins within timeout seconds
+        and b'' if the connection breaks. A message that has begun is read
+        completely, so that the connection stays in step.
+        """
+        try:
+            if not select.select([self.connection], [], [], timeout)[0]:
+                return None
+        except (socket.error, ValueError):
+            return b''
+        return self.peerObject.receive(self.connection,
+                                       self.peerObject.idleTimeout)
+
+
+class SearchResults(object):
+    """
+    Results of one search (see CirrolusPeerV1.searchRequest0). files is a
+    dictionary {username: {hash of the file: hash of the filename}}, answered
+    the amount of the 'asked' peers that replied (or failed). Replies that
+    arrive after the deadline are dropped.
+    """
+    def __init__(self, asked, callback=None):
+        self.files = {}
+        self.asked = asked
+        self.answered = 0
+        self.callback = callback
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def add(self, username, files):
+        """adds the reply of a peer, username is None if it failed"""
+        with self.condition:
+            if self.closed:
+                return
+            self.answered += 1
+            if username is not None:
+                self.files.setdefault(username, {}).update(files)
+            self.condition.notify_all()
+        if username is not None and self.callback is not None:
+            self.callback(username, files)
+
+    def wait(self, deadline):
+        """waits until all peers replied or the deadline (time.time())"""
+        with self.condition:
+            while self.answered < self.asked and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            self.closed = True
+
+
+class StreamReader(object):
+    """
+    Reads a message of unknown size from connection, starting with the
+    bytes 'data' that were already received.
+    """
+    def __init__(self, connection, data=b'', timeout=30):
+        self.connection = connection
+        self.buffer = data
+        connection.settimeout(timeout)
+
+    def read(self, n):
+        """returns the next n bytes, raises IOError if they don't arrive"""
+        parts = [self.buffer]
+        size = len(self.buffer)
+        while size < n:
+            b = self.connection.recv(min(n - size, 2 ** 16))
+            if not b:
+                raise IOError("Connection closed")
+            parts.append(b)
+            size += len(b)
+        data = b''.join(parts)
+        self.buffer = data[n:]
+        return data[:n]
+
+
+class FragmentSender(object):
+    """
+    Writer of a fragment (see CirrolusFiles.createFragments) that streams
+    it to peer while it's encoded, with message 11. The blocks are passed to
+    a sending thread through a queue of at most 'maxsize' blocks, so a slow
+    peer slows down the encoding instead of filling up the memory. finish
+    queues the final header without waiting for the peer, so the fragments
+    of a file are finished together, join waits for the reply and returns
+    True if the peer saved the fragment.
+    If peer can't be reached, the spare peers returned by spares() are
+    tried (None if there are no more), self.peer is the one used. A stream
+    that breaks off isn't retried, the data isn't kept to send it again;
+    nor do the limits of UploadScheduler apply, every fragment needs its
+    stream at the same time.
+    """
+    def __init__(self, peerObject, peer, maxsize=4, timeout=30,
+                 spares=None):
+        self.peerObject = peerObject
+        self.peer = peer
+        self.spares = spares
+        self.timeout = timeout
+        self.blocks = queue.Queue(maxsize)
+        self.successful = False
+        self.thread = threading.Thread(target=self._send)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        if data:
+            self.blocks.put(data)
+
+    def finish(self, header):
+        self.blocks.put(None)
+        self.blocks.put(header)
+
+    def join(self):
+        self.thread.join()
+        return self.successful
+
+    def _send(self):
+        """
+        |n| |block| ... |0| |n| |header|
+        4B              4B  4B
+        """
+        connection = None
+        sent = False
+        try:
+            connection = self._connect()
+            connection.settimeout(self.timeout)
+            connection.sendall(self.peerObject.packMessage(
+                self.peerObject.version, 11))
+            for data in iter(self.blocks.get, None):
+                connection.sendall(struct.pack("!I", len(data)))
+                connection.sendall(data)
+            sent = True
+            header = self.blocks.get()
+            connection.sendall(struct.pack("!II", 0, len(header)) + header)
+            reply = self.peerObject.receive(connection, self.timeout)
+            self.successful = self.peerObject.handleAccordingly(
+                connection, reply, 4)
+        except (IOError, socket.error):
+            self.peerObject.logger.info("Streaming fragment failed")
+        finally:
+            if connection is not None:
+                connection.close()
+        if not sent:
+            # don't block the encoder
+            for data in iter(self.blocks.get, None):
+                pass
+
+    def _connect(self):
+        """
+        connects to self.peer, or to the next spare peer if that fails or
+        self.peer is known to be of version 0, which has no message 11
+        """
+        while True:
+            old = self.peerObject.peerVersions.get(self.peer) == 0
+            try:
+                if old:
+                    raise ConnectionRefusedError
+                return self.peerObject.connectToServer(self.peer)
+            except ConnectionRefusedError:
+                if not old:
+                    self.peerObject.removePeer(self.peer)
+                self.peerObject.logger.info("Could not upload fragment")
+                self.peer = self.spares() if self.spares else None
+                if self.peer is None:
+                    raise
+
+
+class UploadScheduler(object):
+    """
+    Uploads the fragments of files to distinct peers in parallel (see
+    upload). At most 'limit' uploads run at the same time and at most
+    'perPeer' to the same peer, also if several files are uploaded at once.
+    """
+    def __init__(self, peerObject, limit=8, perPeer=2):
+        self.peerObject = peerObject
+        self.slots = threading.BoundedSemaphore(limit)
+        self.perPeer = perPeer
+        self.active = {}    # peer: running uploads
+        self.condition = threading.Condition()
+
+    def upload(self, fragments, peers):
+        """
+        Uploads every fragment, a filename, to its own peer of 'peers', the
+        remaining peers are spares. A fragment whose upload fails is retried
+        on the next spare peer. Returns the list of the peers that stored
+        the fragments, None for the ones that failed.
+        """
+        spares = deque(peers[len(fragments):])
+        results = [None] * len(fragments)
+
+        def upload(i, peer):
+            while peer is not None:
+                if self._send(peer, fragments[i]):
+                    results[i] = peer
+                    return
+                with self.condition:
+                    peer = spares.popleft() if spares else None
+        threads = [threading.Thread(target=upload, args=(i, peer))
+                   for i, peer in enumerate(peers[:len(fragments)])]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        return results
+
+    def _send(self, peer, fragment):
+        with self.condition:
+            while self.active.get(peer, 0) >= self.perPeer:
+                self.condition.wait()
+            self.active[peer] = self.active.get(peer, 0) + 1
+        try:
+            with self.slots:
+                with open(fragment, 'rb') as f:
+                    data = f.read()
+                return self.peerObject.uploadFragment0(peer, data)
+        except IOError:
+            return False
+        finally:
+            with self.condition:
+                self.active[peer] -= 1
+                if not self.active[peer]:
+                    del self.active[peer]
+                self.condition.notify_all()
 
 
 class CirrolusPeerV1(CirrolusPeerCore):
     def __init__(self, host, port=50666, logger=None):
         CirrolusPeerCore.__init__(self, host, port, logger)
-        self.version = 0
-        self.latestSearchResults = {}
+        self.version = 1
+        self.uploads = UploadScheduler(self)
         self.handlersV1 = {
             0: self._handlejoinNet0,
             1: self._handleLeaveNet0,
@@ -205,9 +929,13 @@ class CirrolusPeerV1(CirrolusPeerCore):
             6: self._handleSendFragment0,
             7: self._handleSearchRequest0,
             8: self._handleSearchResults0,
+            9: self._handleRequestPieces0,
+            11: self._handleUploadStream0,
             255: self._handleCheckPeer0,
         }
-        self.versionHandlers[self.version] = self.handlersV1
+        # version 1 only changed the framing
+        self.versionHandlers[0] = self.handlersV1
+        self.versionHandlers[1] = self.handlersV1
 
     def packPeers(self, peers):
         """
@@ -269,13 +997,50 @@ class CirrolusPeerV1(CirrolusPeerCore):
     def _handleUploadFragment0(self, connection, payload):
         """
         Saves the received fragment if possible and replies with a upload
+        report. The fragment is read from connection while it's written to
+        disk (see FragmentManager.saveFragmentStream), payload is only the
+        part that was already received.
+        """
+        reader = StreamReader(connection, payload)
+        successful = False
+        try:
+            n = struct.unpack("!I", reader.read(4))[0]
+            successful = self.fileManager.saveFragmentStream(reader.read, n)
+            self.logger.info("Saving file: " + str(successful))
+        except (IOError, socket.error, struct.error):
+            self.logger.info("Receiving fragment failed")
+        self.uploadReport0(connection, successful=successful)
+
+    def _handleUploadStream0(self, connection, payload):
+        """
+        MessageID 11
+        Receives a fragment streamed by a FragmentSender into a temporary
+        file. The final header follows the payload, it's written over the
+        placeholder at the beginning of the file. Replies with a upload
         report.
         """
-        n = struct.unpack("!I", payload[:4])[0]
+        cf.makeDir(INCOMING)
+        temp = INCOMING + binascii.hexlify(os.urandom(8)).decode()
+        reader = StreamReader(connection, payload)
         successful = False
-        if n <= len(payload[4:]):
-            successful = self.fileManager.saveFragment(payload[4:4+n])
+        try:
+            with open(temp, 'wb') as f:
+                for i in iter(lambda: struct.unpack("!I", reader.read(4))[0], 0):
+                    if i > MAXBLOCK:
+                        raise IOError("Block too large")
+                    f.write(reader.read(i))
+                n = struct.unpack("!I", reader.read(4))[0]
+                if n > f.tell():
+                    raise IOError("Header too large")
+                f.seek(0)
+                f.write(reader.read(n))
+            successful = self.fileManager.saveFragmentFile(temp)
             self.logger.info("Saving file: " + str(successful))
+        except (IOError, socket.error, struct.error):
+            self.logger.info("Receiving fragment failed")
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
         self.uploadReport0(connection, successful=successful)
 
     def _handleUploadReport0(self, connection, payload):
@@ -299,24 +1064,33 @@ class CirrolusPeerV1(CirrolusPeerCore):
             self.logger.info("Handle request fragment")
             self.logger.debug("request: {} | {}".format(hashfile, name))
             try:
-                fragment = self.fileManager.getFragment(name, hashfile)
-                self.sendFragment0(connection, fragment)
-            except FileNotFoundError:
+                parts = self.fileManager.getFragmentParts(name, hashfile)
+            except (FileNotFoundError, RuntimeError):
                 self.sendFragment0(connection)
+            else:
+                self.sendFragmentFile0(connection, parts)
         else:
             self.sendFragment0(connection)
 
     def _handleSendFragment0(self, connection, payload):
+        """
+        Saves the received fragment in the cache. It's read from connection
+        while it's written to disk (see FragmentManager.saveFragmentStream),
+        payload is only the part that was already received. Raises
+        FileNotFoundError if the peer doesn't have the fragment and IOError
+        if it's corrupted.
+        """
         self.logger.info("Handle send fragment")
         if len(payload) >= 4:
             n = struct.unpack("!I", payload[:4])[0]
         else: n = 0
         if n == 0:
             raise FileNotFoundError
-        elif n <= len(payload[4:]):
-            self.fileManager.saveFragment(payload[4:4+n], cached=True)
-        else:
-            raise FileNotFoundError
+        reader = StreamReader(connection, bytes(payload[4:]))
+        if not self.fileManager.saveFragmentStream(reader.read, n,
+                                                   cached=True):
+            self.logger.info("Rejected corrupted fragment")
+            raise IOError("Corrupted fragment")
 
     def _handleSearchRequest0(self, connection, payload):
         if payload[:32] != bs.int2bytes(0, 32):
@@ -329,15 +1103,42 @@ class CirrolusPeerV1(CirrolusPeerCore):
             self.searchResults0(connection, hashfilename, username)
 
     def _handleSearchResults0(self, connection, payload):
+        """
+        MessageID 8
+        Search results are received by searchRequest0 as replies to its
+        requests, unsolicited ones are ignored.
+        """
+
+    def unpackSearchResults0(self, payload):
+        """
+        Returns the username and the files (hash of the file: hash of the
+        filename) of search results, (None, {}) if they are invalid.
+        """
         try:
             n = struct.unpack("!I", payload[:4])[0]
-        except IndexError:
+            data = json.loads(payload[4:4+n].decode())
+            return data["username"], data["files"]
+        except (struct.error, ValueError, KeyError, TypeError):
             return None, {}
-        data = json.loads(payload[4:4+n].decode())
-        user = data["username"]
-        if user not in self.latestSearchResults:
-            self.latestSearchResults[user] = {}
-        self.latestSearchResults[user].update(data["files"])
+
+    def _handleRequestPieces0(self, connection, payload):
+        """
+        MessageID 9
+        Replies with the stripes that hold the pieces [first, last) of the
+        requested fragment and their Merkle proofs.
+        """
+        hashfile = binascii.hexlify(payload[:32]).decode()
+        try:
+            n = bs.byte2int(payload, 32)
+            name = payload[33:33+n].decode()
+            first, last = struct.unpack("!QQ", payload[33+n:49+n])
+            self.logger.info("Handle request pieces")
+            self.logger.debug("request: {} | {} | {}-{}".format(
+                hashfile, name, first, last))
+            self.sendPieces0(connection, *self.fileManager.getPieces(
+                name, hashfile, first, last))
+        except (FileNotFoundError, IndexError, struct.error):
+            self.sendPieces0(connection)
 
     def _handleCheckPeer0(self, connection, payload):
         """
@@ -351,22 +1152,14 @@ class CirrolusPeerV1(CirrolusPeerCore):
         Sends a join message to 'peer'. If getPeers is set, it will be
         waiting for a reply (timeout).
         """
-        try:
-            connection = self.connectToServer(peer)
-            port = struct.pack("!H", self.port)
-            reply = b'\xff' if getPeers else b''
-            payload = b''.join((port, reply))
-            self.send(connection, 0, payload)
-            if getPeers:
-                reply = self.receive(connection)
-                self.handleAccordingly(connection, reply, 2)
-            if peer not in self.peers:
-                self.addPeer(peer)
-        finally:
-            try:
-                connection.close()
-            except:
-                pass
+        port = struct.pack("!H", self.port)
+        reply = b'\xff' if getPeers else b''
+        payload = b''.join((port, reply))
+        reply = self.request(peer, 0, payload, reply=getPeers)
+        if getPeers:
+            self.handleAccordingly(None, reply, 2)
+        if peer not in self.peers:
+            self.addPeer(peer)
 
     def leaveNet0(self):
         """
@@ -374,14 +1167,10 @@ class CirrolusPeerV1(CirrolusPeerCore):
         """
         for peer in self.peers:
             try:
-                connection = self.connectToServer(peer)
+                payload = struct.pack("!H", self.port)
+                self.request(peer, 1, payload, reply=False)
             except ConnectionRefusedError:
                 continue
-            try:
-                payload = struct.pack("!H", self.port)
-                self.send(connection, 1, payload)
-            finally:
-                connection.close()
 
     def sharePeers0(self, connection):
         """
@@ -391,17 +1180,15 @@ class CirrolusPeerV1(CirrolusPeerCore):
         self.send(connection, 2, peers)
 
     def uploadFragment0(self, peer, fragment):
+        n = struct.pack("!I", len(fragment))
+        payload = b''.join((n, fragment))
         try:
-            connection = self.connectToServer(peer)
+            connection, reply = self.openRequest(peer, 3, payload, 10)
         except ConnectionRefusedError:
             self.removePeer(peer)
             self.logger.info("Could not upload fragment")
             return False
         try:
-            n = struct.pack("!I", len(fragment))
-            payload = b''.join((n, fragment))
-            self.send(connection, 3, payload)
-            reply = self.receive(connection, 10)
             return self.handleAccordingly(connection, reply, 4)
         finally:
             connection.close()
@@ -410,28 +1197,31 @@ class CirrolusPeerV1(CirrolusPeerCore):
         payload = b'\xff' if successful else b'\x00'
         self.send(connection, 4, payload)
 
-    def requestFragment0(self, peer, filehash, username):
+    def requestFragment0(self, peer, filehash, username, active=None):
         """
         shaFilename and username have to be a byte-object (Py3)
         [str in py2]
         Returns True if successful
+        The connection is in the set 'active' while it's used, so that the
+        request can be cancelled by shutting it down.
         """
         n = bs.int2byte(len(username))
         payload = b''.join((filehash, n, username))
         try:
-            connection = self.connectToServer(peer)
+            connection, reply = self.openRequest(peer, 5, payload,
+                                                 active=active)
         except ConnectionRefusedError:
             self.removePeer(peer)
             self.logger.info("Could not request fragment")
             return False
         try:
-            self.send(connection, 5, payload)
-            reply = self.receive(connection)
-            self.logger.debug("Requested fragment: {}".format(reply))
+            self.logger.debug("Requested fragment: {}".format(reply[:64]))
             return self.handleAccordingly(connection, reply, 6)
-        except FileNotFoundError:
+        except (FileNotFoundError, IOError):
             return False
         finally:
+            if active is not None:
+                active.discard(connection)
             connection.close()
 
     def sendFragment0(self, connection, data=b''):
@@ -447,52 +1237,147 @@ class CirrolusPeerV1(CirrolusPeerCore):
         else:
             self.send(connection, 6, b'\x00')
 
-    def searchRequest0(self, hashfilename, username):
+    def sendFragmentFile0(self, connection, parts):
+        """
+        Sends a fragment like sendFragment0, it consists of the parts
+        (see FragmentManager.getFragmentParts) that are sent with sendfile.
+        Version 0 receivers only know the size of a message if its beginning
+        arrives in one piece, they get a copy sent with sendFragment0.
+        """
+        if getattr(self.local, "version", self.version) == 0:
+            return self.sendFragment0(connection, cf.readParts(parts))
+        self.logger.info("Send fragment")
+        n = struct.pack("!I", sum(i[2] for i in parts))
+        try:
+            self.sendFiles(connection, 6, n, parts)
+        except (IOError, socket.error):
+            self.logger.info("Sendig failed")
+
+    def requestPieces0(self, peer, filehash, username, first, last):
+        """
+        Requests the pieces [first, last) of the fragment of the file with
+        the hash 'filehash' (bytes) uploaded by username (bytes) from peer.
+        Returns (meta, index of the first piece, pieces) if the stripes
+        received pass verifyStripes, else None. first = last = 0 only
+        requests the meta.
+        """
+        n = bs.int2byte(len(username))
+        payload = b''.join((filehash, n, username,
+                            struct.pack("!QQ", first, last)))
+        try:
+            connection, reply = self.openRequest(peer, 9, payload)
+        except ConnectionRefusedError:
+            self.removePeer(peer)
+            self.logger.info("Could not request pieces")
+            return None
+        connection.close()
+        if not self.isCirrolus(reply):
+            return None
+        version, messageId, payload = self.unpackMessage(reply)
+        if messageId != 10:
+            return None
+        return self.unpackPieces0(payload)
+
+    def sendPieces0(self, connection, header=b'', firstPiece=0, pieces=b'',
+                    proofs=()):
+        """
+        Sends the stripes of a fragment (see FragmentManager.getPieces).
+        Without a header, a message with size 0 is sent.
+        |size| |header| |first piece| |length| |pieces| [|n| |proof|]
+          4B    4096B        8B          8B              1B   n x 32B
+        """
+        if header:
+            data = b''.join([header, struct.pack("!QQ", firstPiece, len(pieces)),
+                             pieces] + [bs.int2byte(len(i)) + b''.join(i)
+                                        for i in proofs])
+        else:
+            data = b''
+        self.send(connection, 10, struct.pack("!I", len(data)) + data)
+
+    def unpackPieces0(self, payload):
+        """
+        Unpacks and verifies the stripes sent with sendPieces0, returns
+        (meta, index of the first piece, pieces) or None.
+        """
+        try:
+            size = struct.unpack("!I", payload[:4])[0]
+            data = payload[4:4+size]
+            meta = cf.unpackBinaryHeader(data[:cf.HEADERSIZE])
+            offset = cf.HEADERSIZE + 16
+            firstPiece, length = struct.unpack("!QQ", data[cf.HEADERSIZE:offset])
+            pieces = data[offset:offset+length]
+            offset += length
+            proofs = []
+            while offset < len(data):
+                n = bs.byte2int(data, offset)
+                proof = data[offset+1:offset+1+32*n]
+                proofs.append([proof[i:i+32] for i in range(0, len(proof), 32)])
+                offset += 1 + 32 * n
+        except (struct.error, IndexError, ValueError):
+            return None
+        if not cf.verifyStripes(meta, firstPiece, pieces, proofs):
+            self.logger.info("Rejected corrupted pieces")
+            return None
+        return meta, firstPiece, pieces
+
+    def searchRequest0(self, hashfilename, username, timeout=4,
+                       callback=None):
+        """
+        Sends the search request to all peers at once and returns the
+        SearchResults that arrived within timeout seconds. If callback is
+        given, callback(username, files) is called with every reply as it
+        arrives.
+        """
         n = bs.int2byte(len(username))
         try:
             username = username.encode()
         except AttributeError:
             pass
         payload = b''.join((hashfilename, n, username))
-        toRemove = []
-        for i in self.peers:
+        deadline = time.time() + timeout
+        peers = list(self.peers)
+        results = SearchResults(len(peers), callback)
+
+        def ask(peer):
             try:
-                connection = self.connectToServer(i)
+                reply = self.request(peer, 7, payload,
+                                     max(deadline - time.time(), 0))
             except ConnectionRefusedError:
-                toRemove.append(i)
-                continue
-            try:
-                self.send(connection, 7, payload)
-                reply = self.receive(connection)
-                self.handleAccordingly(connection, reply, 8)
-            finally:
-                connection.close()
-        for i in toRemove:
-            self.removePeer(i)
+                self.removePeer(peer)
+                reply = b''
+            except socket.error:
+                reply = b''
+            user, files = None, {}
+            if self.isCirrolus(reply):
+                version, messageId, payload_ = self.unpackMessage(reply)
+                if messageId == 8:
+                    user, files = self.unpackSearchResults0(payload_)
+            results.add(user, files)
+
+        for i in peers:
+            thread = threading.Thread(target=ask, args=(i,))
+            thread.daemon = True
+            thread.start()
+        results.wait(deadline)
+        return results
 
     def searchResults0(self, connection, hashfilename, username):
         try:
             files = self.fileManager.getFragmentDict(username, hashfilename)
-            results = json.dumps({"username": username,
-                                  "files": files}).encode()
-            payload = struct.pack("!I", len(results)) + results
-            self.send(connection, 8, payload)
         except (FileNotFoundError, OSError):
-            pass
+            # reply anyway, so that the requester doesn't wait for nothing
+            files = {}
+        results = json.dumps({"username": username, "files": files}).encode()
+        payload = struct.pack("!I", len(results)) + results
+        self.send(connection, 8, payload)
 
     def checkPeer0(self, peer):
         """
         Checks if peer is still online and answers.
         """
         try:
-            connection = self.connectToServer(peer)
-            try:
-                self.send(connection, 255, b'')
-                reply = self.isCirrolus(self.receive(connection, 10))
-                if not reply:
-                    self.removePeer(peer)
-            finally:
-                connection.close()
+            if not self.isCirrolus(self.request(peer, 255, b'', 10)):
+                self.removePeer(peer)
         except ConnectionRefusedError:
             self.removePeer(peer)
 
@@ -569,8 +1454,7 @@ if __name__ == '__main__':
             try:
                 if peerObject.peers:
                     name = values[0]
-                    peerObject.searchRequest0(hash, name)
-                    print(peerObject.latestSearchResults)
+                    print(peerObject.searchRequest0(hash, name).files)
                 else:
                     print("Not connected")
             except IndexError:
@@ -14,15 +14,32 @@ else:
 class SimplePolynomial(object):
     """
     A simple one dimensional integer only polynomial class with few methodes
+
+    If modulus is set, the coefficients are reduced modulo modulus after
+    every operation, so they never grow beyond it. The in-place methods
+    (scale, mulLinear, addScaled) don't create new objects.
     """
-    def __init__(self, coefficients):
+    __slots__ = ("coefficients", "modulus")
+
+    def __init__(self, coefficients, modulus=None):
+        self.modulus = modulus
         if isinstance(coefficients, (integer_types)):
             self.coefficients = [coefficients]
         elif all(isinstance(i, (integer_types)) for i in coefficients):
             self.coefficients = list(coefficients)
-            self._trim_zeros()
         else:
             raise TypeError("unsupported type")
+        self._reduce()
+
+    def _reduce(self):
+        """Reduces the coefficients modulo modulus and trims the zeros"""
+        if self.modulus is not None:
+            m = self.modulus
+            self.coefficients = [i % m for i in self.coefficients]
+        self._trim_zeros()
+
+    def _new(self, coefficients):
+        return self.__class__(coefficients, self.modulus)
 
     def _trim_zeros(self):
         """
@@ -60,15 +77,59 @@ class SimplePolynomial(object):
                 result[i] += shortlist[i]
         else:
             return NotImplemented
-        return self.__class__(result)
+        return self._new(result)
 
     __radd__ = __add__
 
+    def __iadd__(self, other):
+        if isinstance(other, self.__class__):
+            self.addScaled(other, 1)
+            return self
+        return self + other
+
+    def scale(self, scalar):
+        """Multiplies self by the integer scalar in place"""
+        c = self.coefficients
+        for i in range(len(c)):
+            c[i] *= scalar
+        self._reduce()
+        return self
+
+    def mulLinear(self, root):
+        """Multiplies self by (x - root) in place"""
+        c = self.coefficients
+        m = self.modulus
+        c.append(0)
+        for i in range(len(c) - 1, 0, -1):
+            c[i] = c[i-1] - root * c[i]
+            if m is not None:
+                c[i] %= m
+        c[0] = -root * c[0]
+        if m is not None:
+            c[0] %= m
+        self._trim_zeros()
+        return self
+
+    def addScaled(self, other, scalar):
+        """
+        Fused multiply-accumulate: adds scalar * other to self in place
+        """
+        c = self.coefficients
+        m = self.modulus
+        if len(other) > len(c):
+            c.extend([0] * (len(other) - len(c)))
+        for i, value in enumerate(other.coefficients):
+            c[i] += scalar * value
+            if m is not None:
+                c[i] %= m
+        self._trim_zeros()
+        return self
+
     def __mul__(self, other):
         if isinstance(other, (list, tuple)):
             other = self.__class__(other)
         if isinstance(other, (integer_types)):
-            result = [other * i for i in self.coefficients]
+            return self._new(self.coefficients).scale(other)
         elif isinstance(other, self.__class__):
             result = [0] * (len(self) + len(other) - 1)
             for i in range(len(self)):
@@ -76,12 +137,18 @@ class SimplePolynomial(object):
                     result[i + j] += self[i] * other[j]
         else:
             return NotImplemented
-        return self.__class__(result)
+        return self._new(result)
     __rmul__ = __mul__
 
+    def __imul__(self, other):
+        if isinstance(other, (integer_types)):
+            return self.scale(other)
+        return self * other
+
     def __mod__(self, other):
         if isinstance(other, integer_types):
-            return self.__class__([x % other for x in self.coefficients])
+            return self.__class__([x % other for x in self.coefficients],
+                                  self.modulus)
         else:
             return NotImplemented
 
@@ -101,9 +168,14 @@ class SimplePolynomial(object):
         return s
 
     def __call__(self, x, modulo=None):
-        sum_ = sum([self[i] * pow(x, i, modulo) for i in range(len(self))])
-        if modulo is not None:
-            sum_ %= modulo
+        """Evaluates the polynomial at x with the Horner scheme"""
+        if modulo is None:
+            modulo = self.modulus
+        sum_ = 0
+        for c in reversed(self.coefficients):
+            sum_ = sum_ * x + c
+            if modulo is not None:
+                sum_ %= modulo
         return sum_
 
     def __len__(self):
@@ -121,7 +193,7 @@ class SimplePolynomial(object):
     def __setitem__(self, key, val):
         if isinstance(val, (integer_types)):
             self.coefficients[key] = val
-            self._trim_zeros()
+            self._reduce()
         else:
             raise TypeError("unsupported type")
 
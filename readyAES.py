@@ -1,8 +1,18 @@
 import os
+import hashlib
+import hmac
 from Crypto.Cipher import AES
 from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Util import Counter
 import bytesSupport as bs
 
+# streams of StreamEncryptor: MAGIC, nonce, segments of SEGMENTSIZE bytes
+# (the last one shorter), each followed by its HMAC-SHA256 tag
+MAGIC = b"#CLE\x01"
+NONCESIZE = 8
+SEGMENTSIZE = 2 ** 16
+TAGSIZE = 32
+
 
 def genKey(password, salt, keySize=32, iterations=12000):
     try:
@@ -39,3 +49,100 @@ class AESCipher(object):
 
     def _unpad(self, s):
         return s[:-bs.byte2int(s[len(s)-1:])]
+
+
+def _subkeys(key):
+    """returns the AES key and the HMAC key derived from key"""
+    return (hmac.new(key, b"encryption", hashlib.sha256).digest(),
+            hmac.new(key, b"authentication", hashlib.sha256).digest())
+
+
+class _StreamCipher(object):
+    """AES-CTR over the whole stream, every segment tagged with HMAC"""
+    def __init__(self, key, nonce):
+        assert len(key) >= 32
+        encryptionKey, self.macKey = _subkeys(key)
+        self.nonce = nonce
+        self.cipher = AES.new(encryptionKey, AES.MODE_CTR, counter=Counter.new(
+            128, initial_value=bs.bytes2int(nonce) << 64))
+        self.segment = 0
+        self.buffer = b''
+
+    def _tag(self, data, final):
+        tag = hmac.new(self.macKey, self.nonce, hashlib.sha256)
+        tag.update(bs.int2bytes(self.segment, 8))
+        tag.update(b'\x01' if final else b'\x00')
+        tag.update(data)
+        self.segment += 1
+        return tag.digest()
+
+
+class StreamEncryptor(_StreamCipher):
+    """
+    Encrypts a stream passed in arbitrary blocks with update, the returned
+    ciphertexts have to be concatenated, finalize returns the last part.
+    """
+    def __init__(self, key):
+        _StreamCipher.__init__(self, key, os.urandom(NONCESIZE))
+        self.header = MAGIC + self.nonce
+
+    def _seal(self, data, final=False):
+        data = self.cipher.encrypt(data)
+        return data + self._tag(data, final)
+
+    def update(self, data):
+        out = [self.header]
+        self.header = b''
+        self.buffer += data
+        while len(self.buffer) >= SEGMENTSIZE:
+            out.append(self._seal(self.buffer[:SEGMENTSIZE]))
+            self.buffer = self.buffer[SEGMENTSIZE:]
+        return b''.join(out)
+
+    def finalize(self):
+        out = self.header + self._seal(self.buffer, True)
+        self.header = self.buffer = b''
+        return out
+
+
+class StreamDecryptor(_StreamCipher):
+    """
+    Decrypts a stream of StreamEncryptor. Only authenticated plaintext is
+    returned, a ValueError is raised if a segment was modified, reordered or
+    the stream was truncated (or the key is wrong).
+    """
+    def __init__(self, key):
+        self.key = key
+        self.header = b''
+        self.cipher = None
+
+    def _open(self, data, final=False):
+        data, tag = data[:-TAGSIZE], data[-TAGSIZE:]
+        if not hmac.compare_digest(tag, self._tag(data, final)):
+            raise ValueError("Wrong key or corrupted data")
+        return self.cipher.decrypt(data)
+
+    def update(self, data):
+        if self.cipher is None:
+            self.header += data
+            if len(self.header) < len(MAGIC) + NONCESIZE:
+                return b''
+            if not self.header.startswith(MAGIC):
+                raise ValueError("Not an encrypted stream")
+            data = self.header[len(MAGIC) + NONCESIZE:]
+            _StreamCipher.__init__(
+                self, self.key, self.header[len(MAGIC):len(MAGIC) + NONCESIZE])
+        out = []
+        self.buffer += data
+        # the last segment may be a full one, it's only opened by finalize
+        while len(self.buffer) > SEGMENTSIZE + TAGSIZE:
+            out.append(self._open(self.buffer[:SEGMENTSIZE + TAGSIZE]))
+            self.buffer = self.buffer[SEGMENTSIZE + TAGSIZE:]
+        return b''.join(out)
+
+    def finalize(self):
+        if self.cipher is None or len(self.buffer) < TAGSIZE:
+            raise ValueError("Truncated stream")
+        out = self._open(self.buffer, True)
+        self.buffer = b''
+        return out